@@ -1,17 +1,47 @@
 import asyncio
+import bisect
 import copyreg
+import hashlib
+import heapq
+import inspect
+import io
 import json
 import logging
+import mimetypes
+import os
+import pickle
+import queue
 import random
+import re
+import sqlite3
 import string
 import sys
+import threading
+import time
 import uuid
+from base64 import b64decode
 from base64 import b64encode
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 from copy import copy
+from copy import deepcopy
 from enum import Enum
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse
 
+import requests
 import webexpythonsdk
-import websockets
+from markdown import Markdown
+from webexpythonsdk.config import DEFAULT_BASE_URL
+from webexpythonsdk.utils import dict_from_items_with_values
+from webexpythonsdk.utils import is_web_url
 from errbot import rendering
 from errbot.backends.base import Message
 from errbot.backends.base import OFFLINE
@@ -21,7 +51,6 @@ from errbot.backends.base import RoomDoesNotExistError
 from errbot.backends.base import RoomOccupant
 from errbot.backends.base import Stream
 from errbot.core import ErrBot
-from markdown import markdown
 
 __version__ = "2.0.0"
 
@@ -29,6 +58,73 @@ log = logging.getLogger("errbot.backends.CiscoWebexTeams")
 
 CISCO_WEBEX_TEAMS_MESSAGE_SIZE_LIMIT = 7439
 
+PERSON_CACHE_SIZE = 4096
+PERSON_CACHE_TTL = 3600
+
+ROOM_CACHE_SIZE = 4096
+ROOM_CACHE_TTL = 3600
+SENT_MESSAGE_CACHE_SIZE = 10000
+MEMBERSHIP_INDEX_ROOMS = 256
+MEMBERSHIP_INDEX_TTL = 3600
+
+WEBSOCKET_DISPATCH_WORKERS = 8
+WEBSOCKET_DISPATCH_QUEUE_SIZE = 1000
+WEBSOCKET_DISPATCH_ROOM_QUEUE_SIZE = 100
+WEBSOCKET_DISPATCH_ORDERED = True
+
+HTTP_POOL_SIZE = 10
+
+ASYNC_HTTP = False
+ASYNC_HTTP_POOL_SIZE = 100
+
+OUTBOUND_QUEUE = False
+OUTBOUND_WORKERS = 4
+OUTBOUND_ROOM_RATE = 1.0
+OUTBOUND_ROOM_BURST = 5
+OUTBOUND_GLOBAL_RATE = 10.0
+OUTBOUND_GLOBAL_BURST = 20
+
+UPLOAD_CONCURRENCY = 1
+
+CALLBACK_SEND_MESSAGE_ASYNC = False
+
+METRICS_PORT = None
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+KEYED_STORAGE_ENGINE = "errbot"
+KEYED_STORAGE_FLUSH_INTERVAL = 5
+KEYED_STORAGE_MAX_RESIDENT = 10000
+
+MARKDOWN_CACHE_SIZE = 256
+
+WEBSOCKET_PING_INTERVAL = 20
+WEBSOCKET_PING_TIMEOUT = 20
+WEBSOCKET_IDLE_TIMEOUT = 3600
+
+RECONNECT_MULTIPLIER = 1.75
+RECONNECT_MAX_DELAY = 600
+RECONNECT_JITTER = (0, 3)
+
+RESUME_ON_RECONNECT = True
+RESUME_MAX_ROOMS = 500
+RESUME_MAX_MESSAGES = 50
+RESUME_CONCURRENCY = 4
+# Messages older than this many seconds are not replayed, 0 for no limit
+RESUME_MAX_AGE = 3600
+# Backend storage key holding the last message processed in each room, for each bot identity
+ROOM_POSITIONS_STORAGE_KEY = "webex_room_positions"
+
+SEEN_MESSAGES_SIZE = 10000
+SEEN_ACTIVITIES_SIZE = 10000
+SEEN_ACTIVITIES_PERSIST = True
+SEEN_ACTIVITIES_STORAGE_KEY = "webex_seen_activities"
+
+# Smallest page size the paginator will shrink to when a rendered page is over the limit
+MINIMUM_PAGE_SIZE = 256
+
+# Activity verbs that indicate the membership or metadata of a room has changed
+ROOM_ACTIVITY_VERBS = ("add", "leave", "update", "lock", "unlock")
+
 DEVICES_URL = "https://wdm-a.wbx2.com/wdm/api/v1/devices"
 
 DEVICE_DATA = {
@@ -41,6 +137,11 @@ DEVICE_DATA = {
     "systemVersion": "0.1",
 }
 
+# Backend storage key holding the device registered for each bot identity
+DEVICE_STORAGE_KEY = "webex_devices"
+
+DEVICE_CLEANUP = True
+
 # TODO - Need to look at service catalog (somehow?) to determine cluster
 #        for now, static to us cluster
 HYDRA_PREFIX = "ciscospark://us"
@@ -70,304 +171,2494 @@ class FailedToFindWebexTeamsRoom(Exception):
     pass
 
 
-class CiscoWebexTeamsMessage(Message):
+class TTLCache:
     """
-    A Cisco Webex Teams Message
+    A thread safe, size bounded cache whose entries expire after a time to live.
+    The least recently used entry is evicted once the cache is full.
     """
 
-    def __init__(self, *args, **kwargs):
-        super(CiscoWebexTeamsMessage, self).__init__(*args, **kwargs)
-        self.card = None
-        self.card_action = None
-        self.files = None
-
-    @property
-    def is_direct(self) -> bool:
-        return self.extras["roomType"] == "direct"
-
-    @property
-    def is_group(self) -> bool:
-        return not self.is_direct
+    def __init__(self, maxsize, ttl):
+        """
+        :param maxsize: The maximum number of entries to hold. Zero disables the cache.
+        :param ttl: The number of seconds an entry remains valid, or None if entries never expire
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value for a key, or the default if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
 
+            if entry is None:
+                self.misses += 1
+                return default
 
-# noinspection PyProtectedMember
-class CiscoWebexTeamsPerson(Person):
-    """
-    A Cisco Webex Teams Person
-    """
+            expires, value = entry
 
-    def __init__(self, backend, attributes=None):
-        self._backend = backend
-        attributes = attributes or {}
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
 
-        if isinstance(attributes, webexpythonsdk.Person):
-            self.teams_person = attributes
-        else:
-            self.teams_person = webexpythonsdk.Person(attributes)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
 
-    @property
-    def id(self):
-        return self.teams_person.id
+    def set(self, key, value):
+        """
+        Add or replace a value, evicting the least recently used entries if required
+        """
+        if not self.maxsize:
+            return
 
-    @id.setter
-    def id(self, val):
-        self.teams_person._json_data["id"] = val
+        with self._lock:
+            expires = None if self.ttl is None else time.monotonic() + self.ttl
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
 
-    @property
-    def emails(self):
-        return self.teams_person.emails
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
 
-    @emails.setter
-    def emails(self, val):
-        self.teams_person._json_data["emails"] = val
+    def invalidate(self, key=None):
+        """
+        Remove a single key from the cache, or every key if no key is provided
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
 
-    @property
-    def email(self):
-        if type(self.emails) is list:
-            if len(self.emails):
-                # Note sure why a person can have multiple email addresses
-                return self.emails[0]
+    def items(self):
+        """
+        Return a list of the (key, value) pairs in the cache that have not expired
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (key, value)
+                for key, (expires, value) in self._entries.items()
+                if expires is None or expires >= now
+            ]
+
+    def stats(self):
+        """
+        Return the size and hit/miss counters of the cache
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
 
-        return None
+    def __len__(self):
+        return len(self._entries)
 
-    @email.setter
-    def email(self, val):
-        self.emails = [val]
 
-    @property
-    def aclattr(self):
-        return self.teams_person.email
+class SeenEventRing:
+    """
+    A fixed size set of recently seen IDs. A ring of IDs records the order they were added in so
+    that the oldest ID can be forgotten once the ring is full, while a set provides O(1) lookups.
+    """
 
-    @property
-    def displayName(self):
-        return self.teams_person.displayName
+    def __init__(self, size):
+        """
+        :param size: The number of IDs to remember
+        """
+        self.size = size
+        self.dropped = 0
+        self._ring = deque(maxlen=size)
+        self._ids = set()
+        self._lock = threading.Lock()
 
-    @property
-    def created(self):
-        return self.teams_person.created
+    def add(self, id):
+        """
+        Record an ID as seen
+        :param id: The ID
+        :return: False if the ID had already been seen
+        """
+        with self._lock:
+            if id in self._ids:
+                self.dropped += 1
+                return False
 
-    @property
-    def avatar(self):
-        return self.teams_person.avatar
+            if len(self._ring) == self.size:
+                self._ids.discard(self._ring[0])
 
-    @property
-    def nickName(self):
-        return self.teams_person.nickName
+            self._ring.append(id)
+            self._ids.add(id)
+            return True
 
-    def find_using_email(self):
+    def ids(self):
         """
-        Return the FIRST Cisco Webex Teams person found when searching using an email address
+        Return the remembered IDs, oldest first
         """
-        try:
-            for person in self._backend.webex_teams_api.people.list(email=self.email):
-                self.teams_person = person
-                return
-        except:
-            raise FailedToFindWebexTeamsPerson(
-                f"Could not find a user using the email address {self.email}"
-            )
+        with self._lock:
+            return list(self._ring)
 
-    def find_using_name(self):
+    def load(self, ids):
         """
-        Return the FIRST Cisco Webex Teams person found when searching using the display name
+        Remember IDs saved by ids(), for example by a previous run
+        :param ids: The IDs, oldest first
         """
-        try:
-            for person in self._backend.webex_teams_api.people.list(
-                displayName=self.displayName
-            ):
-                self.teams_person = person
-                return
-        except:
-            raise FailedToFindWebexTeamsPerson(
-                f"Could not find the user using the displayName {self.displayName}"
-            )
+        for id in ids:
+            with self._lock:
+                if id in self._ids:
+                    continue
+                if len(self._ring) == self.size:
+                    self._ids.discard(self._ring[0])
+                self._ring.append(id)
+                self._ids.add(id)
 
-    def get_using_id(self):
-        """
-        Return a Cisco Webex Teams person when searching using an ID
-        """
-        try:
-            self.teams_person = self._backend.webex_teams_api.people.get(self.id)
-        except:
-            raise FailedToFindWebexTeamsPerson(
-                f"Could not find the user using the id {self.id}"
-            )
+    def stats(self):
+        return {"size": len(self._ring), "dropped": self.dropped}
 
-    # Required by the Err API
+    def __contains__(self, id):
+        return id in self._ids
 
-    @property
-    def person(self):
-        return self.email
+    def __len__(self):
+        return len(self._ring)
 
-    @property
-    def client(self):
-        return self.id
 
-    @property
-    def nick(self):
-        return self.nickName
+class _SingleFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
-    @property
-    def group_prefix(self):
-        return f"@{self.nick}" or (f"@{self.email.split('@')[0]}" if self.email else "")
 
-    @property
-    def fullname(self):
-        return self.displayName
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key so that only one call is in flight at a time
+    and every caller shares its result (or exception).
+    """
 
-    def json(self):
-        return self.teams_person.json()
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
 
-    def __eq__(self, other):
-        return str(self) == str(other)
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call fn unless a call for the same key is already in flight, in which case wait for
+        that call and return its result
+        :param key: The key identifying the resource being requested
+        :param fn: The callable that fetches the resource
+        :return: The result of the call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
 
-    def __unicode__(self):
-        return self.email
+            if leader:
+                call = self._calls[key] = _SingleFlightCall()
+                self.calls += 1
+            else:
+                self.shared += 1
 
-    __str__ = __unicode__
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
 
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
 
-class CiscoWebexTeamsRoomOccupant(CiscoWebexTeamsPerson, RoomOccupant):
+    def stats(self):
+        """
+        Return the number of calls made and the number of callers that shared an in-flight call
+        """
+        return {"calls": self.calls, "shared": self.shared}
+
+
+class TokenBucket:
     """
-    A Cisco Webex Teams Person that Occupies a Cisco Webex Teams Room
+    A thread safe token bucket. Tokens are reserved up front, so a caller is told how long to
+    wait for its token rather than polling for one.
     """
 
-    def __init__(self, backend, room=None, person=None):
-        room = room or {}
-        person = person or {}
-
-        if isinstance(room, CiscoWebexTeamsRoom):
-            self._room = room
-        else:
-            self._room = CiscoWebexTeamsRoom(backend=backend, room_id=room)
+    def __init__(self, rate, capacity):
+        """
+        :param rate: The number of tokens added per second
+        :param capacity: The maximum number of tokens that can accumulate (the burst size)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
 
-        if isinstance(person, CiscoWebexTeamsPerson):
-            self.teams_person = person
-        else:
-            self.teams_person = CiscoWebexTeamsPerson(
-                backend=backend, attributes=person
+    def reserve(self):
+        """
+        Take a token from the bucket
+        :return: The number of seconds to wait before the token may be used
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
             )
+            self._updated = now
+            self._tokens -= 1
 
-    @property
-    def room(self):
-        return self._room
+            if self._tokens >= 0:
+                return 0.0
 
+            return -self._tokens / self.rate
 
-class CiscoWebexTeamsRoom(Room):
+
+class OutboundScheduler:
     """
-    A Cisco Webex Teams Room
+    Send outbound messages from a pool of worker threads, throttled by a token bucket per room
+    and a global token bucket. Messages for the same room are always sent in the order they were
+    submitted, and a rate limited message is retried after the Retry-After period.
     """
 
-    def __init__(self, backend, room_id=None, room_title=None):
-        self._backend = backend
-        self._room_id = room_id
-        self._room_title = room_title
-        self._room = None
+    def __init__(
+        self, workers, room_rate, room_burst, global_rate, global_burst, max_rooms=4096
+    ):
+        """
+        :param workers: The number of messages that can be sent concurrently (to different rooms)
+        :param room_rate: The number of messages per second allowed to a single room
+        :param room_burst: The number of messages that can be sent to a room in a burst
+        :param global_rate: The number of messages per second allowed across all rooms
+        :param global_burst: The number of messages that can be sent in a burst across all rooms
+        :param max_rooms: The number of room token buckets to hold
+        """
+        self.workers = workers
+        self._room_rate = room_rate
+        self._room_burst = room_burst
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._room_buckets = TTLCache(maxsize=max_rooms, ttl=3600)
+        self._pending = {}
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.throttle_delay = 0.0
+        self.rate_limited = 0
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Queue a call to send a message
+        :param key: Calls with the same key (the room or person) are made in order
+        :param fn: The callable that sends the message
+        :return: A Future that resolves to the result of the call
+        """
+        self._start()
 
-        if room_id is not None and room_title is not None:
-            raise ValueError("room_id and room_title are mutually exclusive")
+        future = Future()
+        job = (fn, args, kwargs, future)
 
-        if not room_id and not room_title:
-            raise ValueError("room_id or room_title is needed")
+        with self._lock:
+            self.queued += 1
+            pending = self._pending.get(key)
 
-        if room_title is not None:
-            self.load_room_from_title()
-        else:
-            self.load_room_from_id()
+            if pending is None:
+                self._pending[key] = deque([job])
+                self._ready.put(key)
+            else:
+                pending.append(job)
 
-    def load_room_from_title(self):
-        """
-        Load a room object from a title. If no room is found, return a new Room object.
-        """
-        rooms = self._backend.webex_teams_api.rooms.list()
-        room = [room for room in rooms if room.title == self._room_title]
+        return future
 
-        if not len(room) > 0:
-            self._room = webexpythonsdk.models.immutable.Room({})
-            self._room_id = None
-        else:
-            # TODO: not sure room title will duplicate
-            self._room = room[0]
-            self._room_id = self._room.id
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
 
-    def load_room_from_id(self):
-        """
-        Load a room object from a webex room id. If no room is found, return a new Room object.
-        """
-        try:
-            self._room = self._backend.webex_teams_api.rooms.get(self._room_id)
-            self._room_title = self._room.title
-        except webexpythonsdk.exceptions.ApiError:
-            self._room = webexpythonsdk.models.immutable.Room({})
+            for worker in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker, name=f"webex-outbound-{worker}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
 
-    @property
-    def id(self):
-        """Return the ID of this room"""
-        return self._room_id
+    def _worker(self):
+        while True:
+            key = self._ready.get()
 
-    @property
-    def room(self):
-        """Return the webexpythonsdk.models.immutable.Room instance"""
-        return self._room
+            with self._lock:
+                job = self._pending[key][0]
 
-    @property
-    def created(self):
-        return self._room.created
+            self._run(key, job)
 
-    @property
-    def title(self):
-        return self._room_title
+            with self._lock:
+                pending = self._pending[key]
+                pending.popleft()
+                self.queued -= 1
 
-    @property
-    def type(self):
-        return self._room.type
+                if pending:
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
 
-    # Errbot API
+    def _bucket(self, key):
+        bucket = self._room_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self._room_rate, self._room_burst)
+            self._room_buckets.set(key, bucket)
+        return bucket
 
-    def join(self, username=None, password=None):
-        log.debug(f"Joining room {self.title} ({self.id})")
+    def _wait(self, delay):
+        self.throttled += 1
+        self.throttle_delay += delay
+        time.sleep(delay)
 
-        # noinspection PyBroadException
-        try:
-            self._backend.webex_teams_api.memberships.create(
-                self.id, self._backend.bot_identifier.id
-            )
-            log.debug(
-                f"{self._backend.bot_identifier.displayName} is NOW a member of {self.title} ({self.id}"
-            )
+    def _run(self, key, job):
+        fn, args, kwargs, future = job
+        bucket = self._bucket(key)
 
-        except webexpythonsdk.exceptions.ApiError as error:
-            # API now returning a 403 when trying to add user to a direct conversation and they are already in the
-            # conversation. For groups if the user is already a member a 409 is returned.
-            if error.response.status_code == 403 or error.response.status_code == 409:
-                log.debug(
-                    f"{self._backend.bot_identifier.displayName} is already a member of {self.title} ({self.id})"
-                )
-            else:
-                log.exception(
-                    f"HTTP Exception: Failed to join room {self.title} ({self.id})"
+        while True:
+            delay = max(bucket.reserve(), self._global_bucket.reserve())
+            if delay:
+                self._wait(delay)
+
+            try:
+                result = fn(*args, **kwargs)
+            except webexpythonsdk.exceptions.RateLimitError as error:
+                self.rate_limited += 1
+                log.warning(
+                    f"Rate limited sending to {key}, retrying in {error.retry_after} seconds"
                 )
+                self._wait(error.retry_after)
+                continue
+            except Exception as error:
+                self.failed += 1
+                log.exception(f"Failed to send message to {key}")
+                future.set_exception(error)
                 return
 
-        except Exception:
-            log.exception(f"Failed to join room {self.title} ({self.id})")
+            self.sent += 1
+            future.set_result(result)
+            return
 
-    def leave(self, reason=None):
+    def stats(self):
         """
-        Leave a room
-
-        Webex Teams does not support leaving a room via the API.
+        Return the number of queued messages and the throttling counters of the scheduler
         """
-        log.debug("Leave room yet to be implemented")
-        pass
+        return {
+            "queued": self.queued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "throttled": self.throttled,
+            "throttle_delay": self.throttle_delay,
+            "rate_limited": self.rate_limited,
+        }
 
-    def create(self):
+
+class WebsocketDispatcher:
+    """
+    Hand websocket events to a fixed number of workers through bounded queues.
+
+    When ordering is enabled each room is pinned to a single worker so that the events for a room
+    are processed in the order they were received. Events are dropped (and counted) when a queue
+    is full rather than being buffered without limit. Each room may only fill part of a queue, so
+    a flood of events in one room is dropped without dropping the events of the other rooms
+    sharing its queue.
+    """
+
+    def __init__(self, handler, workers, queue_size, ordered, room_queue_size=0):
+        """
+        :param handler: The callable (or coroutine function) used to process each event
+        :param workers: The number of events that can be processed concurrently
+        :param queue_size: The maximum number of events waiting in each queue
+        :param ordered: Process the events for a room in the order they were received
+        :param room_queue_size: The maximum number of events waiting for a single room, 0 for no
+            limit other than the queue size
+        """
+        self._handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.room_queue_size = room_queue_size
+        self._pending = {}
+        self._dropping = {}
+        self.dropped_by_room = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="webex-dispatch"
+        )
+        self._queues = []
+        self._tasks = []
+        self.dispatched = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        """
+        Start the workers on the current event loop if they are not already running
+        """
+        if self._tasks and not any(task.done() for task in self._tasks):
+            return
+
+        for task in self._tasks:
+            task.cancel()
+
+        # The events of the previous queues are discarded with them
+        self._pending = {}
+
+        queue_count = self.workers if self.ordered else 1
+        self._queues = [
+            asyncio.Queue(maxsize=self.queue_size) for _ in range(queue_count)
+        ]
+        self._tasks = [
+            asyncio.ensure_future(self._worker(self._queues[worker % queue_count]))
+            for worker in range(self.workers)
+        ]
+
+    def dispatch(self, key, *args):
+        """
+        Queue an event to be processed
+        :param key: Events with the same key are processed in order (when ordering is enabled)
+        :param args: The arguments passed to the handler to process the event
+        """
+        queue = self._queues[hash(key) % len(self._queues)]
+
+        pending = self._pending.get(key, 0)
+        if self.room_queue_size and pending >= self.room_queue_size:
+            self._drop(key, f"it has {pending} events waiting")
+            return
+
+        try:
+            queue.put_nowait((time.monotonic(), key, args))
+        except asyncio.QueueFull:
+            self._drop(key, f"the dispatch queue is full ({self.queue_size})")
+            return
+
+        self._pending[key] = pending + 1
+        self.dispatched += 1
+
+        dropped = self._dropping.pop(key, 0)
+        if dropped:
+            log.warning(f"Dropped {dropped} websocket events for {key}")
+
+    def _drop(self, key, reason):
+        self.dropped += 1
+        self.dropped_by_room[key] = self.dropped_by_room.get(key, 0) + 1
+
+        # Log the start of a burst of drops, and its total once events are accepted again
+        if key not in self._dropping:
+            log.warning(f"Dropping websocket events for {key} as {reason}")
+        self._dropping[key] = self._dropping.get(key, 0) + 1
+
+    async def _worker(self, queue):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            queued, key, args = await queue.get()
+
+            pending = self._pending.pop(key, 1) - 1
+            if pending:
+                self._pending[key] = pending
+
+            # noinspection PyBroadException
+            try:
+                if asyncio.iscoroutinefunction(self._handler):
+                    await self._handler(*args)
+                else:
+                    await loop.run_in_executor(self._executor, self._handler, *args)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                log.exception("An exception occurred while processing websocket event")
+            finally:
+                latency = time.monotonic() - queued
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                queue.task_done()
+
+    def stats(self):
+        """
+        Return the queue depth and counters of the dispatcher
+        """
+        completed = self.processed + self.failed
+        return {
+            "queue_depth": sum(queue.qsize() for queue in self._queues),
+            "dispatched": self.dispatched,
+            "dropped": self.dropped,
+            "dropped_by_room": dict(self.dropped_by_room),
+            "processed": self.processed,
+            "failed": self.failed,
+            "latency_avg": self.latency_total / completed if completed else 0.0,
+            "latency_max": self.latency_max,
+        }
+
+
+class AsyncWebexApiError(Exception):
+    """
+    Raised when the async transport receives an error response from the Webex Teams API
+    """
+
+    def __init__(self, status, message):
+        super().__init__(f"[{status}] {message}")
+        self.status = status
+
+
+class AsyncWebexTransport:
+    """
+    A minimal async client for the Webex Teams REST API. A single pooled keep-alive session is
+    shared by all requests, and responses are returned as the same webexpythonsdk models used
+    by the rest of the backend.
+
+    Requires the optional aiohttp package.
+    """
+
+    def __init__(
+        self, access_token, pool_size, base_url=DEFAULT_BASE_URL, metrics=None
+    ):
+        """
+        :param access_token: The default Webex Teams bot token
+        :param pool_size: The maximum number of connections held open in the pool
+        :param base_url: The base URL of the Webex Teams REST API
+        :param metrics: The MetricsRegistry to record the latency of each request in
+        """
+        import aiohttp
+
+        self._aiohttp = aiohttp
+        self.access_token = access_token
+        self._base_url = base_url
+        self.pool_size = pool_size
+        self.metrics = metrics
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = self._aiohttp.ClientSession(
+                connector=self._aiohttp.TCPConnector(limit=self.pool_size),
+                headers={"Content-Type": "application/json"},
+            )
+
+        return self._session
+
+    async def request(self, method, path, token=None, **kwargs):
+        """
+        Make a request to the Webex Teams API, waiting and retrying when rate limited
+        :param method: The HTTP method
+        :param path: The path of the resource, relative to the base URL
+        :param token: The bot token to make the request with, if not the default
+        :return: The decoded JSON response
+        """
+        headers = {"Authorization": f"Bearer {token or self.access_token}"}
+
+        while True:
+            start = time.perf_counter()
+            async with self._get_session().request(
+                method, self._base_url + path, headers=headers, **kwargs
+            ) as response:
+                if self.metrics:
+                    self.metrics.record_request(
+                        method,
+                        self._base_url + path,
+                        response.status,
+                        time.perf_counter() - start,
+                    )
+
+                if response.status == 429:
+                    retry_after = int(response.headers.get("Retry-After", 15))
+                    log.warning(
+                        f"Rate limited on {method} {path}, retrying in {retry_after} seconds"
+                    )
+                    await asyncio.sleep(max(1, retry_after))
+                    continue
+
+                if response.status >= 400:
+                    raise AsyncWebexApiError(response.status, await response.text())
+
+                if response.status == 204:
+                    return {}
+
+                return await response.json()
+
+    async def get_message(self, message_id, token=None):
+        return webexpythonsdk.Message(
+            await self.request("GET", f"messages/{message_id}", token=token)
+        )
+
+    async def get_attachment_action(self, action_id, token=None):
+        return webexpythonsdk.AttachmentAction(
+            await self.request("GET", f"attachment/actions/{action_id}", token=token)
+        )
+
+    async def get_person(self, person_id, token=None):
+        return webexpythonsdk.Person(
+            await self.request("GET", f"people/{person_id}", token=token)
+        )
+
+    async def get_room(self, room_id, token=None):
+        return webexpythonsdk.Room(
+            await self.request("GET", f"rooms/{room_id}", token=token)
+        )
+
+    async def create_message(self, token=None, **kwargs):
+        """
+        Create a message. Files are not supported and must be sent with webexpythonsdk.
+        """
+        return webexpythonsdk.Message(
+            await self.request(
+                "POST",
+                "messages",
+                token=token,
+                json=dict_from_items_with_values(**kwargs),
+            )
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class MarkdownRenderer:
+    """
+    Render message bodies into the markdown accepted by Webex Teams. The markdown parser is created
+    once per thread and reset between uses, and recently rendered bodies are served from an LRU cache.
+    """
+
+    def __init__(self, cache_size):
+        """
+        :param cache_size: The number of rendered bodies to cache. Zero disables the cache.
+        """
+        self._local = threading.local()
+        self._errbot_md = rendering.md()
+        self.cache = TTLCache(maxsize=cache_size, ttl=None)
+
+    def _parser(self):
+        if not hasattr(self._local, "md"):
+            self._local.md = Markdown(
+                extensions=[
+                    "markdown.extensions.nl2br",
+                    "markdown.extensions.fenced_code",
+                ]
+            )
+
+        return self._local.md
+
+    def render(self, body):
+        """
+        Render a message body
+        :param body: The markdown body of the message
+        :return: The rendered body
+        """
+        key = hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+        rendered = self.cache.get(key)
+        if rendered is None:
+            # Need to strip out "markdown extra" as not supported by Webex Teams
+            rendered = self._parser().reset().convert(self._errbot_md.convert(body))
+            self.cache.set(key, rendered)
+
+        return rendered
+
+
+class MarkdownPaginator:
+    """
+    Split a long markdown body into pages in a single pass over its lines. Pages are split on line
+    boundaries, fenced code blocks are closed at the end of a page and reopened at the start of the
+    next, and the header of a table is repeated on each page the table spans. If any page is still
+    over the limit once rendered, the body is split again using a proportionally smaller page size.
+    """
+
+    FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})(.*)$")
+    TABLE_SEPARATOR_RE = re.compile(r"^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$")
+
+    def __init__(self, limit, measure=len):
+        """
+        :param limit: The maximum size of a page
+        :param measure: Return the size of a page once rendered
+        """
+        self.limit = limit
+        self.measure = measure
+
+    def paginate(self, body):
+        """
+        Split a body into pages that are each within the limit once rendered
+        :param body: The markdown body
+        :return: A list of pages
+        """
+        page_size = self.limit
+
+        while True:
+            pages = self._split(body, page_size)
+            largest = max(self.measure(page) for page in pages)
+
+            if largest <= self.limit or page_size <= MINIMUM_PAGE_SIZE:
+                return pages
+
+            page_size = max(
+                MINIMUM_PAGE_SIZE,
+                min(page_size - 1, int(page_size * self.limit / largest)),
+            )
+
+    def _split(self, body, page_size):
+        if len(body) <= page_size:
+            return [body]
+
+        pages = []
+        page = []
+        page_length = 0
+        has_content = False
+        fence = None
+        fence_open = None
+        previous = None
+        table_header = None
+
+        for line in self._lines(body, page_size):
+            closes = fence is not None and self._closes_fence(line, fence)
+            # Room is kept to close an open fence, unless this line is the closing fence itself
+            closing = len(fence) + 1 if fence and not closes else 0
+
+            if has_content and page_length + len(line) + 1 + closing > page_size:
+                carried = []
+                if (
+                    fence is None
+                    and len(page) > 1
+                    and "|" in page[-1]
+                    and self.TABLE_SEPARATOR_RE.match(line)
+                ):
+                    # Keep the header row of a table with its separator
+                    carried.append(page.pop())
+
+                if fence:
+                    page.append(fence)
+                pages.append("\n".join(page))
+
+                page = []
+                if fence:
+                    page.append(fence_open)
+                elif table_header and "|" in line:
+                    page.extend(table_header)
+                page.extend(carried)
+                page_length = sum(len(reopened) + 1 for reopened in page)
+                has_content = bool(carried)
+
+            page.append(line)
+            page_length += len(line) + 1
+            has_content = True
+
+            if fence is None:
+                opening = self._opening_fence(line)
+                if opening:
+                    fence, fence_open = opening, line
+                    table_header = None
+                elif "|" not in line:
+                    table_header = None
+                elif (
+                    previous is not None
+                    and "|" in previous
+                    and self.TABLE_SEPARATOR_RE.match(line)
+                ):
+                    table_header = [previous, line]
+            elif closes:
+                fence = None
+
+            previous = line
+
+        if has_content:
+            if fence:
+                page.append(fence)
+            pages.append("\n".join(page))
+
+        return pages
+
+    def _opening_fence(self, line):
+        """
+        Return the run of backticks or tildes that opens a fenced code block, or None
+        """
+        match = self.FENCE_RE.match(line)
+        if match is None:
+            return None
+
+        run, info = match.groups()
+        # A backtick fence can not have backticks in its info string, so a line such as
+        # ```make test``` is inline code rather than the opening of a fence
+        if run[0] == "`" and "`" in info:
+            return None
+
+        return run
+
+    def _closes_fence(self, line, fence):
+        """
+        Check whether a line closes a fenced code block, which requires a run of the same
+        character that is at least as long as the fence, and nothing after it
+        """
+        match = self.FENCE_RE.match(line)
+        if match is None:
+            return False
+
+        run, info = match.groups()
+        return run[0] == fence[0] and len(run) >= len(fence) and not info.strip()
+
+    @staticmethod
+    def _lines(body, page_size):
+        """
+        Yield the lines of a body, breaking any line that could never fit on a page
+        """
+        # Leave room for a fence to be opened and closed around a broken line
+        width = max(1, page_size - 32)
+
+        for line in body.split("\n"):
+            while len(line) > width:
+                yield line[:width]
+                line = line[width:]
+            yield line
+
+
+class RoomTitleIndex:
+    """
+    An index of the titles of the rooms the bot is a member of. The index is built lazily
+    from a single pass of rooms.list() and then kept up to date from websocket activity.
+
+    Where more than one room shares the same title, the oldest room (then the lowest ID) is returned.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._built = False
+        self._lock = threading.RLock()
+        self._titles = {}
+        self._rooms = {}
+
+    def build(self):
+        """
+        Populate the index (and the room cache) from the rooms the bot is a member of
+        """
+        with self._lock:
+            if self._built:
+                return
+
+            log.debug("Building the room title index")
+
+            for room in self._backend.webex_teams_api.rooms.list():
+                self._add(room)
+                self._backend.room_cache.set(room.id, room)
+
+            self._built = True
+
+            log.debug(f"Room title index built with {len(self._rooms)} rooms")
+
+    def find(self, title):
+        """
+        Return the ID of the room with the given title
+        :param title: The title of the room
+        :return: The room ID or None if the bot is not a member of a room with that title
+        """
+        self.build()
+
+        with self._lock:
+            rooms = self._titles.get(title)
+            if not rooms:
+                return None
+
+            return min(rooms.items(), key=lambda item: (item[1], item[0]))[0]
+
+    def update(self, room):
+        """
+        Add or update a room in the index
+        :param room: A webexpythonsdk.Room
+        """
+        with self._lock:
+            if self._built:
+                self._add(room)
+
+    def remove(self, room_id):
+        """
+        Remove a room from the index
+        :param room_id: The ID of the room
+        """
+        with self._lock:
+            self._remove(room_id)
+
+    def refresh(self, room_id):
+        """
+        Reload a single room into the index, removing it if the bot no longer has access to it
+        :param room_id: The ID of the room
+        """
+        if not self._built:
+            return
+
+        try:
+            room = self._backend.single_flight.do(
+                f"rooms:{room_id}", self._backend.webex_teams_api.rooms.get, room_id
+            )
+        except webexpythonsdk.exceptions.ApiError:
+            self.remove(room_id)
+            return
+
+        self._backend.room_cache.set(room_id, room)
+        self.update(room)
+
+    def invalidate(self):
+        """
+        Discard the index so that it is rebuilt on next use
+        """
+        with self._lock:
+            self._built = False
+            self._titles.clear()
+            self._rooms.clear()
+
+    def _add(self, room):
+        self._remove(room.id)
+        created = str(room.created)
+        self._rooms[room.id] = (room.title, created)
+        self._titles.setdefault(room.title, {})[room.id] = created
+
+    def _remove(self, room_id):
+        title, _ = self._rooms.pop(room_id, (None, None))
+        rooms = self._titles.get(title)
+        if rooms is None:
+            return
+
+        rooms.pop(room_id, None)
+        if not rooms:
+            del self._titles[title]
+
+    def __contains__(self, room_id):
+        self.build()
+        return room_id in self._rooms
+
+    def __len__(self):
+        return len(self._rooms)
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms, exposed in the Prometheus text format. Values that are already
+    counted elsewhere (queue depths, cache hits) are read from collectors when scraped.
+    """
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        """
+        :param buckets: The upper bounds of the histogram buckets
+        """
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+        self._server = None
+
+    def counter(self, name, help):
+        self._metrics[name] = ("counter", help, {})
+
+    def histogram(self, name, help):
+        self._metrics[name] = ("histogram", help, {})
+
+    def collector(self, name, type, help, fn):
+        """
+        Register a metric whose samples are read when scraped
+        :param type: The Prometheus metric type, counter or gauge
+        :param fn: Returns a list of (labels dictionary, value)
+        """
+        self._collectors.append((name, type, help, fn))
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            samples = self._metrics[name][2]
+            samples[key] = samples.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            samples = self._metrics[name][2]
+            sample = samples.get(key)
+            if sample is None:
+                # The count of each bucket, then the sum and count of the observations
+                sample = samples[key] = [0] * (len(self.buckets) + 2)
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample[index] += 1
+            sample[-2] += value
+            sample[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the number of seconds taken by the body of the with statement
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def exposition(self):
+        """
+        Return every metric in the Prometheus text exposition format
+        """
+        lines = []
+
+        with self._lock:
+            metrics = [
+                (name, type, help, dict(samples))
+                for name, (type, help, samples) in self._metrics.items()
+            ]
+
+        for name, type, help, samples in metrics:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+            for key, sample in samples.items():
+                labels = dict(key)
+                if type != "histogram":
+                    lines.append(f"{name}{self._labels(labels)} {sample}")
+                    continue
+
+                for bound, count in zip(self.buckets, sample):
+                    lines.append(
+                        f"{name}_bucket{self._labels({**labels, 'le': bound})} {count}"
+                    )
+                lines += [
+                    f"{name}_bucket{self._labels({**labels, 'le': '+Inf'})} {sample[-1]}",
+                    f"{name}_sum{self._labels(labels)} {sample[-2]}",
+                    f"{name}_count{self._labels(labels)} {sample[-1]}",
+                ]
+
+        for name, type, help, fn in self._collectors:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+            # noinspection PyBroadException
+            try:
+                lines += [
+                    f"{name}{self._labels(labels)} {value}" for labels, value in fn()
+                ]
+            except Exception:
+                log.exception(f"Failed to collect the {name} metric")
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        """
+        Serve the metrics over HTTP, from a background thread, for Prometheus to scrape
+        :param port: The TCP port to listen on
+        """
+        if self._server is not None:
+            return
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.exposition().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(
+            target=self._server.serve_forever, name="webex-metrics", daemon=True
+        ).start()
+        log.info(f"Serving metrics on port {port}")
+
+    def record_request(self, method, url, status, seconds):
+        """
+        Record the latency and status of a call to the REST API
+        """
+        endpoint = self.endpoint(url)
+        self.observe(
+            "webex_http_request_seconds",
+            seconds,
+            method=method,
+            endpoint=endpoint,
+            status=status,
+        )
+        if status == 429:
+            self.inc("webex_http_rate_limited_total", endpoint=endpoint)
+
+    @staticmethod
+    def endpoint(url):
+        """
+        Reduce the URL of a REST call to its endpoint, dropping the IDs so that it can be used as a label
+        """
+        return "/".join(
+            segment
+            for segment in urlparse(url).path.strip("/").split("/")
+            if segment.isalpha()
+        )
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+
+        escaped = (
+            (
+                key,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for key, value in labels.items()
+        )
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class ErrbotStorageEngine:
+    """
+    A keyed storage engine that keeps the dictionary of each ID as a single entry in the errbot
+    storage of the backend, as remember() always has. A changed dictionary is rewritten in full,
+    but only once per flush however many of its keys changed.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def load(self, id):
+        return dict(self._backend.get(id, {}))
+
+    def load_many(self, ids):
+        return {id: self.load(id) for id in ids}
+
+    def load_all(self):
+        # The backend also keeps its own state (devices, seen activities) in this storage
+        values = {}
+        for id in self._backend.keys():
+            if id.startswith("webex_"):
+                continue
+
+            value = self._backend.get(id)
+            if isinstance(value, dict):
+                values[id] = dict(value)
+
+        return values
+
+    def save(self, id, values, changed, deleted):
+        self._backend[id] = values
+
+    def close(self):
+        pass
+
+
+class SQLiteStorageEngine:
+    """
+    A keyed storage engine that keeps each key of each ID as its own row of an SQLite database, so
+    only the keys that changed are written
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path of the SQLite database file
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS webex_keyed_storage "
+                "(id, key, value BLOB, PRIMARY KEY (id, key))"
+            )
+
+    def load(self, id):
+        return self.load_many([id])[id]
+
+    def load_many(self, ids):
+        ids = list(ids)
+        values = {id: {} for id in ids}
+
+        # Stay well within the SQLite limit on the number of query parameters
+        for chunk in range(0, len(ids), 500):
+            batch = ids[chunk : chunk + 500]
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT id, key, value FROM webex_keyed_storage WHERE id IN "
+                    f"({', '.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+
+            for id, key, value in rows:
+                values[id][key] = pickle.loads(value)
+
+        return values
+
+    def load_all(self):
+        values = {}
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, key, value FROM webex_keyed_storage"
+            ).fetchall()
+
+        for id, key, value in rows:
+            values.setdefault(id, {})[key] = pickle.loads(value)
+
+        return values
+
+    def save(self, id, values, changed, deleted):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO webex_keyed_storage (id, key, value) "
+                "VALUES (?, ?, ?)",
+                [(id, key, pickle.dumps(values[key])) for key in changed],
+            )
+            self._connection.executemany(
+                "DELETE FROM webex_keyed_storage WHERE id = ? AND key = ?",
+                [(id, key) for key in deleted],
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class KeyedStore:
+    """
+    Field level access to a dictionary per ID (room or person), on top of a storage engine.
+
+    Dictionaries are loaded from the engine on first use and held in memory, up to max_resident
+    of them: the least recently used dictionaries without unwritten changes are dropped beyond
+    that, and loaded again when next needed. Changes are buffered and written behind by a
+    background thread every flush_interval seconds (or immediately when the interval is 0), so a
+    burst of updates to an ID results in a single write. Values are copied in and out of the
+    store, so changing a returned value does not change the stored one.
+
+    The IDs holding each key, and the sorted IDs, are indexed so that scans by key or ID prefix
+    only visit the matching IDs. Keys can be set with a time to live, after which they are deleted.
+    """
+
+    # The key of each dictionary that holds the expiry times of its keys
+    EXPIRES_KEY = "_webex_expires"
+
+    def __init__(self, engine, flush_interval, max_resident):
+        """
+        :param engine: The storage engine (ErrbotStorageEngine or SQLiteStorageEngine)
+        :param flush_interval: The number of seconds changes are buffered for, 0 to write through
+        :param max_resident: The number of dictionaries without unwritten changes held in memory
+        """
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self.max_resident = max_resident
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._values = OrderedDict()
+        self._changed = {}
+        self._deleted = {}
+        self._flushing = set()
+        self._keys = {}
+        self._known = set()
+        self._ids = []
+        self._complete = False
+        self._expiries = []
+        self._scheduled = set()
+        self._stop = threading.Event()
+        self._thread = None
+        self.writes = 0
+
+    def get(self, id, key, default=None):
+        """
+        Return a copy of the value of a key of an ID, or the default if it is not set
+        """
+        with self._lock:
+            values = self._lookup(id)
+            if values is None:
+                return default
+
+            self._expire_key(id, values, key)
+            value = deepcopy(values[key]) if key in values else default
+            self._evict()
+            expired = self._dirty()
+
+        if expired:
+            self._written()
+        return value
+
+    def get_many(self, ids, key, default=None):
+        """
+        Return the value of a key for each of a number of IDs, loading any IDs not yet in memory
+        from the engine in a single batch
+        :return: A dictionary of ID to a copy of the value (or the default if it is not set)
+        """
+        with self._lock:
+            loaded = self._lookup_many(ids)
+            results = {}
+            for id in ids:
+                values = loaded.get(id)
+                if values is not None:
+                    self._expire_key(id, values, key)
+
+                if values is not None and key in values:
+                    results[id] = deepcopy(values[key])
+                else:
+                    results[id] = default
+
+            self._evict()
+            expired = self._dirty()
+
+        if expired:
+            self._written()
+        return results
+
+    def get_all(self, id):
+        """
+        Return a copy of the dictionary of an ID
+        """
+        with self._lock:
+            values = self._lookup(id)
+            if values is None:
+                return {}
+
+            values = self._public(id, values)
+            self._evict()
+            expired = self._dirty()
+
+        if expired:
+            self._written()
+        return values
+
+    def set(self, id, key, value, ttl=None):
+        """
+        Set the value of a key of an ID
+        :param ttl: The number of seconds after which the key is deleted, or None to keep it
+        """
+        with self._lock:
+            self._set(id, key, value, ttl)
+
+        self._written()
+
+    def set_many(self, mapping, ttl=None):
+        """
+        Set the values of keys of many IDs at once
+        :param mapping: A dictionary of ID to a dictionary of keys and values
+        :param ttl: The number of seconds after which the keys are deleted, or None to keep them
+        """
+        with self._lock:
+            self._lookup_many(list(mapping))
+            for id, values in mapping.items():
+                for key, value in values.items():
+                    self._set(id, key, value, ttl)
+
+        self._written()
+
+    def delete(self, id, key):
+        """
+        Delete a key of an ID
+        :return: The deleted value or None if the key was not set
+        """
+        with self._lock:
+            values = self._lookup(id)
+            if values is None:
+                return None
+
+            self._expire_key(id, values, key)
+            if key not in values:
+                return None
+
+            value = self._delete(id, values, key)
+
+        self._written()
+        return value
+
+    def update(self, id, key, fn, default=None, ttl=None):
+        """
+        Atomically replace the value of a key of an ID with the result of a function of its
+        current value. No other change to the store is made while the function runs.
+        :param fn: Called with a copy of the current value (or the default) and returns the new value
+        :param ttl: The number of seconds after which the key is deleted, or None to keep it
+        :return: A copy of the new value
+        """
+        with self._lock:
+            values = self._lookup(id)
+            if values is not None:
+                self._expire_key(id, values, key)
+
+            if values is not None and key in values:
+                current = deepcopy(values[key])
+            else:
+                current = default
+
+            value = fn(current)
+            self._set(id, key, value, ttl)
+            value = deepcopy(value)
+
+        self._written()
+        return value
+
+    def scan(self, key=None, prefix=None):
+        """
+        Return the IDs that have a key and/or start with a prefix. Every ID is indexed from the
+        engine the first time the store is scanned, after which scans are served from the index.
+        :param key: Only return the IDs that have this key
+        :param prefix: Only return the IDs that start with this prefix
+        :return: A dictionary of ID to a copy of the value of the key, or to a copy of the
+            dictionary of the ID when no key is given
+        """
+        with self._lock:
+            self._load_all()
+            self._expire()
+
+            if self._ids is None:
+                self._ids = sorted(self._known)
+
+            if prefix is None:
+                ids = self._ids
+            else:
+                ids = self._ids[
+                    bisect.bisect_left(self._ids, prefix) : bisect.bisect_left(
+                        self._ids, prefix + "\uffff"
+                    )
+                ]
+
+            if key is not None:
+                holders = self._keys.get(key, set())
+                if len(holders) < len(ids):
+                    ids = sorted(id for id in holders if id.startswith(prefix or ""))
+                else:
+                    ids = [id for id in ids if id in holders]
+
+                loaded = self._lookup_many(ids)
+                results = {
+                    id: deepcopy(loaded[id][key])
+                    for id in ids
+                    if key in loaded.get(id, {})
+                }
+            else:
+                loaded = self._lookup_many(ids)
+                results = {
+                    id: self._public(id, loaded[id]) for id in ids if id in loaded
+                }
+                results = {id: values for id, values in results.items() if values}
+
+            self._evict()
+            expired = self._dirty()
+
+        if expired:
+            self._written()
+        return results
+
+    def flush(self):
+        """
+        Write the buffered changes to the engine
+        """
+        with self._flush_lock:
+            with self._lock:
+                changes = [
+                    (
+                        id,
+                        dict(self._values[id]),
+                        self._changed.pop(id, set()),
+                        self._deleted.pop(id, set()),
+                    )
+                    for id in set(self._changed) | set(self._deleted)
+                ]
+                # Not evicted until written, so a failed write can be retried
+                self._flushing = {id for id, _, _, _ in changes}
+
+            for id, values, changed, deleted in changes:
+                # noinspection PyBroadException
+                try:
+                    self.engine.save(id, values, changed, deleted)
+                    self.writes += 1
+                except Exception:
+                    log.exception(f"Failed to save the keys of {id}")
+                    with self._lock:
+                        self._changed.setdefault(id, set()).update(
+                            changed - self._deleted.get(id, set())
+                        )
+                        self._deleted.setdefault(id, set()).update(
+                            deleted - self._changed.get(id, set())
+                        )
+
+            with self._lock:
+                self._flushing = set()
+                self._evict()
+
+    def start(self):
+        """
+        Start writing buffered changes, and deleting expired keys, in the background
+        """
+        if not self.flush_interval or self._thread:
+            return
+
+        self._thread = threading.Thread(
+            target=self._run, name="webex-keyed-storage", daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        """
+        Stop the background writer, write any buffered changes and close the engine
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+        self.engine.close()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            with self._lock:
+                self._expire()
+            self.flush()
+
+    def _set(self, id, key, value, ttl):
+        values = self._lookup(id)
+        if values is None:
+            values = self._add(id, {})
+
+        values[key] = deepcopy(value)
+        self._changed.setdefault(id, set()).add(key)
+        self._deleted.get(id, set()).discard(key)
+        self._keys.setdefault(key, set()).add(id)
+
+        expires = values.get(self.EXPIRES_KEY, {})
+        if ttl is not None:
+            deadline = time.time() + ttl
+            values[self.EXPIRES_KEY] = {**expires, key: deadline}
+            self._schedule(deadline, id, key)
+            self._changed[id].add(self.EXPIRES_KEY)
+        elif key in expires:
+            self._clear_expiry(id, values, key)
+
+    def _delete(self, id, values, key):
+        value = values.pop(key)
+        self._deleted.setdefault(id, set()).add(key)
+        self._changed.get(id, set()).discard(key)
+        self._keys.get(key, set()).discard(id)
+
+        if key in values.get(self.EXPIRES_KEY, {}):
+            self._clear_expiry(id, values, key)
+
+        return value
+
+    def _clear_expiry(self, id, values, key):
+        expires = {
+            expiring: deadline
+            for expiring, deadline in values[self.EXPIRES_KEY].items()
+            if expiring != key
+        }
+        if expires:
+            values[self.EXPIRES_KEY] = expires
+            self._changed.setdefault(id, set()).add(self.EXPIRES_KEY)
+        else:
+            del values[self.EXPIRES_KEY]
+            self._deleted.setdefault(id, set()).add(self.EXPIRES_KEY)
+            self._changed.get(id, set()).discard(self.EXPIRES_KEY)
+
+    def _expire_key(self, id, values, key):
+        deadline = values.get(self.EXPIRES_KEY, {}).get(key)
+        if deadline is not None and deadline <= time.time() and key in values:
+            self._delete(id, values, key)
+
+    def _schedule(self, deadline, id, key):
+        # Dictionaries loaded again after being evicted do not schedule their expiries twice
+        if (deadline, id, key) not in self._scheduled:
+            self._scheduled.add((deadline, id, key))
+            heapq.heappush(self._expiries, (deadline, id, key))
+
+    def _expire(self):
+        now = time.time()
+        while self._expiries and self._expiries[0][0] <= now:
+            entry = heapq.heappop(self._expiries)
+            self._scheduled.discard(entry)
+            deadline, id, key = entry
+
+            # Evicted dictionaries are loaded again so the key is deleted from the engine
+            values = self._lookup(id)
+            # Skip keys that have since been deleted or set again
+            if values and values.get(self.EXPIRES_KEY, {}).get(key) == deadline:
+                self._delete(id, values, key)
+
+    def _public(self, id, values):
+        now = time.time()
+        expires = values.get(self.EXPIRES_KEY, {})
+        for key, deadline in list(expires.items()):
+            if deadline <= now and key in values:
+                self._delete(id, values, key)
+
+        return {
+            key: deepcopy(value)
+            for key, value in values.items()
+            if key != self.EXPIRES_KEY
+        }
+
+    def _lookup(self, id):
+        """
+        Return the dictionary of an ID, loading it from the engine if it is not in memory, or
+        None if the ID has nothing stored. Missing IDs are not added to the store.
+        """
+        values = self._values.get(id)
+        if values is not None:
+            self._values.move_to_end(id)
+            return values
+
+        if self._complete and id not in self._known:
+            return None
+
+        values = self.engine.load(id)
+        return self._add(id, values) if values else None
+
+    def _lookup_many(self, ids):
+        """
+        Return the dictionaries of the IDs that have something stored, loading those not in
+        memory from the engine in a single batch
+        """
+        found = {}
+        missing = []
+        for id in ids:
+            values = self._values.get(id)
+            if values is not None:
+                self._values.move_to_end(id)
+                found[id] = values
+            elif not self._complete or id in self._known:
+                missing.append(id)
+
+        if missing:
+            for id, values in self.engine.load_many(missing).items():
+                if values and id not in found:
+                    found[id] = self._add(id, values)
+
+        return found
+
+    def _load_all(self):
+        """
+        Index every ID held by the engine, without holding their dictionaries in memory
+        """
+        if self._complete:
+            return
+
+        for id, values in self.engine.load_all().items():
+            if id not in self._values:
+                self._index(id, values)
+
+        self._complete = True
+
+    def _add(self, id, values):
+        self._values[id] = values
+        self._index(id, values)
+        return values
+
+    def _index(self, id, values):
+        if id not in self._known:
+            self._known.add(id)
+            # Sorted again on the next scan by prefix
+            self._ids = None
+
+        for key in values:
+            if key != self.EXPIRES_KEY:
+                self._keys.setdefault(key, set()).add(id)
+
+        for key, deadline in values.get(self.EXPIRES_KEY, {}).items():
+            self._schedule(deadline, id, key)
+
+    def _evict(self):
+        """
+        Drop the least recently used dictionaries beyond max_resident. Dictionaries with changes
+        that have not been written yet are always kept.
+        """
+        excess = len(self._values) - self.max_resident
+        if excess <= 0:
+            return
+
+        for id in list(self._values):
+            if excess <= 0:
+                break
+
+            if (
+                id not in self._changed
+                and id not in self._deleted
+                and id not in self._flushing
+            ):
+                del self._values[id]
+                excess -= 1
+
+    def _dirty(self):
+        # Reads delete any keys found to have expired, which must be written like other changes
+        return bool(self._changed or self._deleted)
+
+    def _written(self):
+        if not self.flush_interval:
+            self.flush()
+        else:
+            with self._lock:
+                self._evict()
+
+
+def card_action(**inputs):
+    """
+    Decorator marking a plugin method as the handler for card actions whose inputs contain all of
+    the given values, for example @card_action(callback="deploy")
+    """
+
+    def decorate(fn):
+        fn._webex_card_action = tuple(inputs.items())
+        return fn
+
+    return decorate
+
+
+class PluginCallbackRegistry:
+    """
+    The plugin methods that handle the callbacks specific to this backend. The handlers for each
+    callback name, and the card action routes, are found once and then reused for as long as the
+    set of active plugins is unchanged, rather than inspecting every plugin on every callback.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._lock = threading.Lock()
+        self._active = None
+        self._handlers = {}
+        self._routes = None
+
+    def handlers(self, name):
+        """
+        Return the (plugin name, bound method) of every active plugin implementing a callback
+        :param name: The name of the callback method
+        """
+        plugins = self._plugins()
+
+        with self._lock:
+            self._refresh(plugins)
+
+            handlers = self._handlers.get(name)
+            if handlers is None:
+                handlers = [
+                    (plugin.name, getattr(plugin, name))
+                    for plugin in plugins
+                    if callable(getattr(plugin, name, None))
+                ]
+                self._handlers[name] = handlers
+
+        return handlers
+
+    def card_routes(self, inputs):
+        """
+        Return the (plugin name, bound method) of every @card_action handler matching the inputs
+        of a card action
+        :param inputs: The inputs of the card action
+        """
+        plugins = self._plugins()
+
+        with self._lock:
+            self._refresh(plugins)
+
+            routes = self._routes
+            if routes is None:
+                routes = self._routes = self._build_routes(plugins)
+
+        matched = []
+        for item in inputs.items():
+            try:
+                candidates = routes.get(item, ())
+            except TypeError:
+                # Unhashable input values can not be routed on
+                continue
+
+            for required, plugin_name, method in candidates:
+                if (plugin_name, method) not in matched and all(
+                    inputs.get(key) == value for key, value in required
+                ):
+                    matched.append((plugin_name, method))
+
+        return matched
+
+    def invalidate(self):
+        """
+        Discard the registry so that it is rebuilt from the active plugins on next use
+        """
+        with self._lock:
+            self._active = None
+            self._handlers = {}
+            self._routes = None
+
+    def _refresh(self, plugins):
+        """
+        Discard the registry if the active plugins differ from those it was built from. errbot
+        injects a plugin's commands before marking it as activated (and removes them after it is
+        deactivated), so invalidate() alone could leave a registry built from a stale plugin set.
+        Must be called with the lock held.
+        :param plugins: The currently active plugins
+        """
+        active = tuple(plugins)
+        if active != self._active:
+            self._active = active
+            self._handlers = {}
+            self._routes = None
+
+    @staticmethod
+    def _build_routes(plugins):
+        routes = {}
+        for plugin in plugins:
+            for _, method in inspect.getmembers(plugin, inspect.ismethod):
+                required = getattr(method, "_webex_card_action", None)
+                if not required:
+                    continue
+
+                # Index each route by its first required input, the rest are checked on match
+                routes.setdefault(required[0], []).append(
+                    (required, plugin.name, method)
+                )
+
+        return routes
+
+    def _plugins(self):
+        plugin_manager = getattr(self._backend, "plugin_manager", None)
+        if plugin_manager is None:
+            return []
+
+        return plugin_manager.get_all_active_plugins()
+
+
+class _RoomMembers:
+    """
+    The members of a single room, by UUID and by email address
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.emails = {}
+
+    def add(self, uuid, person_id, email):
+        self.ids[uuid] = (person_id, email)
+        if email:
+            self.emails[email.lower()] = uuid
+
+    def remove(self, uuid):
+        _, email = self.ids.pop(uuid, (None, None))
+        if email:
+            self.emails.pop(email.lower(), None)
+
+
+class RoomMembershipIndex:
+    """
+    An index of the members of rooms, holding only the ID and email address of each member. The
+    members of a room are loaded on first use and then kept up to date from membership websocket
+    activity, so counting the members of a room, or checking whether someone is a member, does
+    not fetch the whole roster each time.
+    """
+
+    def __init__(self, backend, maxsize, ttl):
+        """
+        :param backend: The CiscoWebexTeamsBackend
+        :param maxsize: The number of rooms to hold members for
+        :param ttl: The number of seconds the members of a room are held for
+        """
+        self._backend = backend
+        self._rooms = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def members(self, room_id, api=None):
+        """
+        Yield the ID and email address of each member of a room. When the room is not indexed
+        the memberships are streamed from the API a page at a time, and indexed once complete.
+        :param room_id: The ID of the room
+        :param api: The WebexAPI to load the memberships with, by default that of the active identity
+        """
+        members = self._rooms.get(room_id)
+        if members is not None:
+            with self._lock:
+                items = list(members.ids.values())
+            yield from items
+            return
+
+        members = _RoomMembers()
+        api = api or self._backend.webex_teams_api
+        for membership in api.memberships.list(roomId=room_id):
+            members.add(
+                self._backend.parse_hydra_id(membership.personId),
+                membership.personId,
+                membership.personEmail,
+            )
+            yield membership.personId, membership.personEmail
+
+        self._rooms.set(room_id, members)
+
+    def count(self, room_id, api=None):
+        """
+        Return the number of members of a room, loading the room into the index if needed
+        :param room_id: The ID of the room
+        :param api: The WebexAPI to load the memberships with, by default that of the active identity
+        """
+        members = self._load(room_id, api)
+        return len(members.ids)
+
+    def contains(self, room_id, person_id=None, email=None, api=None):
+        """
+        Check whether a person is a member of a room. When the room is not indexed a single
+        membership lookup is made rather than loading the roster.
+        :param room_id: The ID of the room
+        :param person_id: The ID of the person
+        :param email: The email address of the person, when the ID is not known
+        :param api: The WebexAPI to look up the membership with, by default that of the active identity
+        """
+        members = self._rooms.get(room_id)
+        if members is not None:
+            if person_id:
+                return self._backend.parse_hydra_id(person_id) in members.ids
+            return bool(email) and email.lower() in members.emails
+
+        query = {"personId": person_id} if person_id else {"personEmail": email}
+        api = api or self._backend.webex_teams_api
+        memberships = api.memberships.list(roomId=room_id, max=1, **query)
+        return next(iter(memberships), None) is not None
+
+    def add(self, room_id, uuid, person_id, email):
+        """
+        Add a member to an indexed room
+        :param room_id: The ID of the room
+        :param uuid: The UUID of the person
+        :param person_id: The ID of the person
+        :param email: The email address of the person
+        """
+        members = self._rooms.get(room_id)
+        if members is not None:
+            with self._lock:
+                members.add(uuid, person_id, email)
+
+    def remove(self, room_id, uuid):
+        """
+        Remove a member from an indexed room
+        :param room_id: The ID of the room
+        :param uuid: The UUID of the person
+        """
+        members = self._rooms.get(room_id)
+        if members is not None:
+            with self._lock:
+                members.remove(uuid)
+
+    def invalidate(self, room_id=None):
+        """
+        Discard the members of a room, or of every room, so that they are reloaded on next use
+        :param room_id: The ID of the room or None for every room
+        """
+        self._rooms.invalidate(room_id)
+
+    def _load(self, room_id, api=None):
+        members = self._rooms.get(room_id)
+        if members is not None:
+            return members
+
+        def load():
+            for _ in self.members(room_id, api):
+                pass
+            return self._rooms.get(room_id) or _RoomMembers()
+
+        return self._backend.single_flight.do(f"memberships:{room_id}", load)
+
+
+class CiscoWebexTeamsIdentity:
+    """
+    A bot identity (token) served by the backend. Each identity has its own WebexAPI, device and
+    websocket, while the HTTP connection pool, event loop and caches are shared by all identities.
+    """
+
+    def __init__(self, backend, token, adapter):
+        """
+        :param backend: The CiscoWebexTeamsBackend serving this identity
+        :param token: The Webex Teams bot token
+        :param adapter: The requests HTTPAdapter (connection pool) shared by all identities
+        """
+        self.token = token
+        # Identifies the token in the backend storage without storing the token itself
+        self.token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        self.api = webexpythonsdk.WebexAPI(access_token=token)
+
+        # The outbound scheduler handles rate limiting itself, so it uses a dedicated
+        # WebexAPI that raises on a 429 rather than sleeping inside the SDK
+        self.outbound_api = webexpythonsdk.WebexAPI(
+            access_token=token, wait_on_rate_limit=False
+        )
+
+        # noinspection PyProtectedMember
+        for api in (self.api, self.outbound_api):
+            api._session._req_session.mount("https://", adapter)
+            # Called for every HTTP response, including those retried by webexpythonsdk
+            api._session._req_session.hooks["response"].append(
+                backend.record_response
+            )
+
+        self.room_index = RoomTitleIndex(backend)
+        self.room_positions = TTLCache(maxsize=backend.resume_max_rooms, ttl=None)
+        self.connected_at = None
+        self.reconnects = 0
+        self.reconnect_delay = 1
+        self.device_info = None
+        self.bot_identifier = None
+        self.bot_uuid = None
+
+    @property
+    def email(self):
+        return self.bot_identifier.email if self.bot_identifier else None
+
+
+class BulkSendResult:
+    """
+    The outcome of sending to a single target of CiscoWebexTeamsBackend.send_bulk()
+    """
+
+    def __init__(self, target):
+        """
+        :param target: The target as provided to send_bulk()
+        """
+        self.target = target
+        self.message_ids = []
+        self.error = None
+
+    @property
+    def message_id(self):
+        """
+        The ID of the first message sent to the target
+        """
+        return self.message_ids[0] if self.message_ids else None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return (
+            f"<BulkSendResult target={self.target!r} message_ids={self.message_ids} "
+            f"error={self.error!r}>"
+        )
+
+
+class CiscoWebexTeamsMessage(Message):
+    """
+    A Cisco Webex Teams Message
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CiscoWebexTeamsMessage, self).__init__(*args, **kwargs)
+        self.card = None
+        self.card_action = None
+        self.files = None
+
+    @property
+    def is_direct(self) -> bool:
+        return self.extras["roomType"] == "direct"
+
+    @property
+    def is_group(self) -> bool:
+        return not self.is_direct
+
+
+# noinspection PyProtectedMember
+class CiscoWebexTeamsPerson(Person):
+    """
+    A Cisco Webex Teams Person
+
+    Only the ID, email address and display name are held. The full webexpythonsdk.Person is
+    loaded (through the person cache) the first time any other attribute is needed, using the
+    bot identity that was active when the person was created.
+    """
+
+    # errbot's Identifier base classes do not define __slots__, so instances still carry a
+    # __dict__, but the attributes of the identifier itself are kept out of it
+    __slots__ = (
+        "_backend",
+        "_identity",
+        "_id",
+        "_email",
+        "_display_name",
+        "_teams_person",
+    )
+
+    def __init__(self, backend, attributes=None):
+        self._backend = backend
+        self._identity = backend.active_identity
+        self._id = None
+        self._email = None
+        self._display_name = None
+        self._teams_person = None
+
+        if isinstance(attributes, webexpythonsdk.Person):
+            self.teams_person = attributes
+        elif attributes:
+            self._id = attributes.get("id")
+            self.emails = attributes.get("emails")
+            self._display_name = attributes.get("displayName")
+
+    @property
+    def teams_person(self):
+        """
+        Return the webexpythonsdk.Person, loading it if it has not been loaded yet
+        """
+        if self._teams_person is None:
+            # noinspection PyBroadException
+            try:
+                if self._id:
+                    self.get_using_id()
+                elif self._email:
+                    self.find_using_email()
+            except FailedToFindWebexTeamsPerson:
+                log.debug(f"Could not load the details of {self._id or self._email}")
+
+        if self._teams_person is None:
+            self._teams_person = webexpythonsdk.Person(
+                {
+                    "id": self._id,
+                    "emails": self.emails,
+                    "displayName": self._display_name,
+                }
+            )
+
+        return self._teams_person
+
+    @teams_person.setter
+    def teams_person(self, person):
+        self._teams_person = person
+        self._id = person.id
+        self.emails = person.emails
+        self._display_name = person.displayName
+
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, val):
+        self._id = val
+        self._teams_person = None
+
+    @property
+    def emails(self):
+        return [self._email] if self._email else None
+
+    @emails.setter
+    def emails(self, val):
+        self._email = val[0] if val else None
+
+    @property
+    def email(self):
+        return self._email
+
+    @email.setter
+    def email(self, val):
+        self._email = val
+
+    @property
+    def aclattr(self):
+        return self.email
+
+    @property
+    def displayName(self):
+        if self._display_name is None and self._teams_person is None:
+            return self.teams_person.displayName
+
+        return self._display_name
+
+    @property
+    def created(self):
+        return self.teams_person.created
+
+    @property
+    def avatar(self):
+        return self.teams_person.avatar
+
+    @property
+    def nickName(self):
+        return self.teams_person.nickName
+
+    def find_using_email(self):
+        """
+        Return the FIRST Cisco Webex Teams person found when searching using an email address
+        """
+        person = self._backend.person_cache.get(f"email:{self.email}")
+        if person is not None:
+            self.teams_person = person
+            return
+
+        try:
+            person = self._backend.single_flight.do(
+                f"people:email:{self.email}",
+                lambda: next(
+                    iter(self._identity.api.people.list(email=self.email)), None
+                ),
+            )
+            if person is not None:
+                self.teams_person = person
+                self._backend.cache_person(person)
+        except:
+            raise FailedToFindWebexTeamsPerson(
+                f"Could not find a user using the email address {self.email}"
+            )
+
+    def find_using_name(self):
+        """
+        Return the FIRST Cisco Webex Teams person found when searching using the display name
+        """
+        try:
+            for person in self._identity.api.people.list(
+                displayName=self.displayName
+            ):
+                self.teams_person = person
+                return
+        except:
+            raise FailedToFindWebexTeamsPerson(
+                f"Could not find the user using the displayName {self.displayName}"
+            )
+
+    def get_using_id(self):
+        """
+        Return a Cisco Webex Teams person when searching using an ID
+        """
+        person = self._backend.person_cache.get(f"id:{self.id}")
+        if person is not None:
+            self.teams_person = person
+            return
+
+        try:
+            self.teams_person = self._backend.single_flight.do(
+                f"people:{self.id}", self._identity.api.people.get, self.id
+            )
+            self._backend.cache_person(self.teams_person)
+        except:
+            raise FailedToFindWebexTeamsPerson(
+                f"Could not find the user using the id {self.id}"
+            )
+
+    # Required by the Err API
+
+    @property
+    def person(self):
+        return self.email
+
+    @property
+    def client(self):
+        return self.id
+
+    @property
+    def nick(self):
+        return self.nickName
+
+    @property
+    def group_prefix(self):
+        return f"@{self.nick}" or (f"@{self.email.split('@')[0]}" if self.email else "")
+
+    @property
+    def fullname(self):
+        return self.displayName
+
+    def json(self):
+        return self.teams_person.json()
+
+    @property
+    def _key(self):
+        return CiscoWebexTeamsBackend.parse_hydra_id(self.id) if self.id else self.email
+
+    def __eq__(self, other):
+        if isinstance(other, CiscoWebexTeamsPerson):
+            return self._key == other._key
+
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __unicode__(self):
+        return self.email
+
+    __str__ = __unicode__
+
+
+class CiscoWebexTeamsRoomOccupant(CiscoWebexTeamsPerson, RoomOccupant):
+    """
+    A Cisco Webex Teams Person that Occupies a Cisco Webex Teams Room
+    """
+
+    __slots__ = ("_room",)
+
+    def __init__(self, backend, room=None, person=None):
+        if isinstance(person, CiscoWebexTeamsPerson):
+            super().__init__(backend)
+            self._identity = person._identity
+            self._id = person._id
+            self._email = person._email
+            self._display_name = person._display_name
+            self._teams_person = person._teams_person
+        else:
+            super().__init__(backend, attributes=person)
+
+        # A room given by ID is only loaded when it is needed
+        self._room = room
+
+    @property
+    def room(self):
+        if not isinstance(self._room, CiscoWebexTeamsRoom):
+            with self._backend.identity_context(self._identity):
+                self._room = CiscoWebexTeamsRoom(
+                    backend=self._backend, room_id=self._room
+                )
+
+        return self._room
+
+    @property
+    def room_id(self):
+        if isinstance(self._room, CiscoWebexTeamsRoom):
+            return self._room.id
+
+        return self._room
+
+
+class CiscoWebexTeamsRoom(Room):
+    """
+    A Cisco Webex Teams Room
+
+    A room identified by its ID only loads the webexpythonsdk.Room (through the room cache) the
+    first time its details are needed. The room is loaded, and managed, using the bot identity
+    that was active when the room was created.
+    """
+
+    __slots__ = (
+        "_backend",
+        "_identity",
+        "_room_id",
+        "_room_title",
+        "_room_type",
+        "_room",
+    )
+
+    def __init__(self, backend, room_id=None, room_title=None, room_type=None):
+        self._backend = backend
+        self._identity = backend.active_identity
+        self._room_id = room_id
+        self._room_title = room_title
+        self._room_type = room_type
+        self._room = None
+
+        if room_id is not None and room_title is not None:
+            raise ValueError("room_id and room_title are mutually exclusive")
+
+        if not room_id and not room_title:
+            raise ValueError("room_id or room_title is needed")
+
+        if room_title is not None:
+            self.load_room_from_title()
+
+    def load_room_from_title(self):
+        """
+        Load a room object from a title. If no room is found, return a new Room object.
+        """
+        self._room_id = self._identity.room_index.find(self._room_title)
+
+        if self._room_id is None:
+            self._room_type = None
+            self._room = webexpythonsdk.models.immutable.Room({})
+        else:
+            self.load_room_from_id()
+
+    def load_room_from_id(self):
+        """
+        Load a room object from a webex room id. If no room is found, return a new Room object.
+        """
+        room = self._backend.room_cache.get(self._room_id)
+        if room is not None:
+            self._room = room
+            self._room_title = room.title
+            return
+
+        try:
+            self._room = self._backend.single_flight.do(
+                f"rooms:{self._room_id}",
+                self._identity.api.rooms.get,
+                self._room_id,
+            )
+            self._room_title = self._room.title
+            self._backend.room_cache.set(self._room_id, self._room)
+        except webexpythonsdk.exceptions.ApiError:
+            self._room = webexpythonsdk.models.immutable.Room({})
+
+    @property
+    def id(self):
+        """Return the ID of this room"""
+        return self._room_id
+
+    @property
+    def room(self):
+        """Return the webexpythonsdk.models.immutable.Room instance"""
+        if self._room is None:
+            self.load_room_from_id()
+        return self._room
+
+    @property
+    def created(self):
+        return self.room.created
+
+    @property
+    def title(self):
+        if self._room is None:
+            self.load_room_from_id()
+        return self._room_title
+
+    @property
+    def type(self):
+        return self._room_type or self.room.type
+
+    # Errbot API
+
+    def join(self, username=None, password=None):
+        log.debug(f"Joining room {self.title} ({self.id})")
+
+        # noinspection PyBroadException
+        try:
+            bot_identifier = self._identity.bot_identifier
+            self._identity.api.memberships.create(self.id, bot_identifier.id)
+            log.debug(
+                f"{bot_identifier.displayName} is NOW a member of {self.title} ({self.id}"
+            )
+
+        except webexpythonsdk.exceptions.ApiError as error:
+            # API now returning a 403 when trying to add user to a direct conversation and they are already in the
+            # conversation. For groups if the user is already a member a 409 is returned.
+            if error.response.status_code == 403 or error.response.status_code == 409:
+                log.debug(
+                    f"{self._identity.bot_identifier.displayName} is already a member "
+                    f"of {self.title} ({self.id})"
+                )
+            else:
+                log.exception(
+                    f"HTTP Exception: Failed to join room {self.title} ({self.id})"
+                )
+                return
+
+        except Exception:
+            log.exception(f"Failed to join room {self.title} ({self.id})")
+
+    def leave(self, reason=None):
+        """
+        Leave a room
+
+        Webex Teams does not support leaving a room via the API.
+        """
+        log.debug("Leave room yet to be implemented")
+        pass
+
+    def create(self):
         """
         Create a new room. Membership to the room is provided by default.
         """
-        self._room = self._backend.webex_teams_api.rooms.create(self.title)
+        self._room = self._identity.api.rooms.create(self.title)
         self._room_id = self._room.id
-        self._backend.webex_teams_api.messages.create(
+        self._backend.room_cache.set(self._room_id, self._room)
+        self._identity.room_index.update(self._room)
+        self._identity.api.messages.create(
             roomId=self._room_id, text="Welcome to the room!"
         )
         log.debug(f"Created room: {self.title}")
@@ -377,7 +2668,9 @@ class CiscoWebexTeamsRoom(Room):
         Destroy (delete) a room
         :return:
         """
-        self._backend.webex_teams_api.rooms.delete(self.id)
+        self._identity.api.rooms.delete(self.id)
+        self._backend.room_cache.invalidate(self.id)
+        self._identity.room_index.remove(self.id)
         # We want to re-init this room so that is accurately reflected that
         # it no longer exists
         self.load_room_from_title()
@@ -385,12 +2678,11 @@ class CiscoWebexTeamsRoom(Room):
 
     @property
     def exists(self):
-        return self._room.created is not None
+        return self.room.created is not None
 
     @property
     def joined(self):
-        rooms = self._backend.webex_teams_api.rooms.list()
-        return len([room for room in rooms if room.title == room.title]) > 0
+        return self.id in self._identity.room_index
 
     @property
     def topic(self):
@@ -403,34 +2695,77 @@ class CiscoWebexTeamsRoom(Room):
 
     @property
     def occupants(self):
+        occupants = list(self.iter_occupants())
+
+        log.debug(
+            f"Total occupants for room {self.title} ({self.id}) is {len(occupants)}"
+        )
+
+        return occupants
+
+    def iter_occupants(self):
+        """
+        Yield the occupants of the room one at a time, rather than building the whole list
+        """
         if not self.exists:
             raise RoomDoesNotExistError(
                 f"Room {self.title or self.id} does not exist, or the bot does not have access"
             )
 
-        occupants = []
-
-        for person in self._backend.webex_teams_api.memberships.list(roomId=self.id):
+        members = self._backend.membership_index.members(self.id, self._identity.api)
+        for person_id, email in members:
             p = CiscoWebexTeamsPerson(backend=self._backend)
-            p.id = person.personId
-            p.email = person.personEmail
-            occupants.append(
-                CiscoWebexTeamsRoomOccupant(backend=self._backend, room=self, person=p)
+            p._identity = self._identity
+            p.id = person_id
+            p.email = email
+            yield CiscoWebexTeamsRoomOccupant(backend=self._backend, room=self, person=p)
+
+    @property
+    def occupant_count(self):
+        """
+        Return the number of occupants of the room
+        """
+        return self._backend.membership_index.count(self.id, self._identity.api)
+
+    def has_occupant(self, person):
+        """
+        Check whether a person is an occupant of the room
+
+        :param person: A CiscoWebexTeamsPerson or an email address
+        """
+        if isinstance(person, CiscoWebexTeamsPerson):
+            return self._backend.membership_index.contains(
+                self.id,
+                person_id=person.id,
+                email=person.email,
+                api=self._identity.api,
             )
 
-        log.debug(
-            f"Total occupants for room {self.title} ({self.id}) is {len(occupants)}"
+        return self._backend.membership_index.contains(
+            self.id, email=person, api=self._identity.api
         )
 
-        return occupants
-
     def invite(self, *args):
         log.debug("Invite room yet to be implemented")  # TODO
         pass
 
     def __eq__(self, other):
+        if isinstance(other, CiscoWebexTeamsRoom):
+            return self._key == other._key
+
         return str(self) == str(other)
 
+    def __hash__(self):
+        return hash(self._key)
+
+    @property
+    def _key(self):
+        return (
+            CiscoWebexTeamsBackend.parse_hydra_id(self.id)
+            if self.id
+            else self._room_title
+        )
+
     def __unicode__(self):
         return self.title
 
@@ -448,7 +2783,14 @@ class CiscoWebexTeamsBackend(ErrBot):
 
         bot_identity = config.BOT_IDENTITY
 
-        self.md = rendering.md()
+        self.metrics = MetricsRegistry(
+            buckets=getattr(config, "METRICS_LATENCY_BUCKETS", METRICS_LATENCY_BUCKETS)
+        )
+        self.metrics_port = getattr(config, "METRICS_PORT", METRICS_PORT)
+
+        self.renderer = MarkdownRenderer(
+            cache_size=getattr(config, "MARKDOWN_CACHE_SIZE", MARKDOWN_CACHE_SIZE)
+        )
 
         # Do we have the basic mandatory config needed to operate the bot
         self._bot_token = bot_identity.get("TOKEN", None)
@@ -471,92 +2813,800 @@ class CiscoWebexTeamsBackend(ErrBot):
             log.fatal("PERMITTED_DOMAINS must be of type 'list' or 'set' in config.py.")
             sys.exit(1)
 
-        log.debug("Setting up WebexAPI")
-        self.webex_teams_api = webexpythonsdk.WebexAPI(access_token=self._bot_token)
+        self.person_cache = TTLCache(
+            maxsize=getattr(config, "PERSON_CACHE_SIZE", PERSON_CACHE_SIZE),
+            ttl=getattr(config, "PERSON_CACHE_TTL", PERSON_CACHE_TTL),
+        )
 
-        log.debug("Setting up device on Webex Teams")
-        self.device_info = self._get_device_info()
+        self.room_cache = TTLCache(
+            maxsize=getattr(config, "ROOM_CACHE_SIZE", ROOM_CACHE_SIZE),
+            ttl=getattr(config, "ROOM_CACHE_TTL", ROOM_CACHE_TTL),
+        )
 
-        log.debug("Fetching and building identifier for the bot itself.")
-        self.bot_identifier = CiscoWebexTeamsPerson(
-            self, self.webex_teams_api.people.me()
+        self.single_flight = SingleFlight()
+
+        # The thread (parentId) and room type of the messages sent by the bot, so that the
+        # context of a card action on one of them is known without fetching the message
+        self.sent_messages = TTLCache(
+            maxsize=getattr(config, "SENT_MESSAGE_CACHE_SIZE", SENT_MESSAGE_CACHE_SIZE),
+            ttl=None,
+        )
+
+        self.callbacks = PluginCallbackRegistry(self)
+        self.callback_send_message_async = getattr(
+            config, "CALLBACK_SEND_MESSAGE_ASYNC", CALLBACK_SEND_MESSAGE_ASYNC
+        )
+
+        self.membership_index = RoomMembershipIndex(
+            self,
+            maxsize=getattr(config, "MEMBERSHIP_INDEX_ROOMS", MEMBERSHIP_INDEX_ROOMS),
+            ttl=getattr(config, "MEMBERSHIP_INDEX_TTL", MEMBERSHIP_INDEX_TTL),
+        )
+
+        self.seen_messages = SeenEventRing(
+            getattr(config, "SEEN_MESSAGES_SIZE", SEEN_MESSAGES_SIZE)
+        )
+        self.seen_activities = SeenEventRing(
+            getattr(config, "SEEN_ACTIVITIES_SIZE", SEEN_ACTIVITIES_SIZE)
+        )
+        self.seen_activities_persist = getattr(
+            config, "SEEN_ACTIVITIES_PERSIST", SEEN_ACTIVITIES_PERSIST
+        )
+        self.websocket_ping_interval = getattr(
+            config, "WEBSOCKET_PING_INTERVAL", WEBSOCKET_PING_INTERVAL
+        )
+        self.websocket_ping_timeout = getattr(
+            config, "WEBSOCKET_PING_TIMEOUT", WEBSOCKET_PING_TIMEOUT
+        )
+        self.websocket_idle_timeout = getattr(
+            config, "WEBSOCKET_IDLE_TIMEOUT", WEBSOCKET_IDLE_TIMEOUT
+        )
+
+        # Also used by errbot when serve_once() returns or raises
+        self._reconnection_multiplier = getattr(
+            config, "RECONNECT_MULTIPLIER", RECONNECT_MULTIPLIER
+        )
+        self._reconnection_max_delay = getattr(
+            config, "RECONNECT_MAX_DELAY", RECONNECT_MAX_DELAY
+        )
+        self._reconnection_jitter = getattr(
+            config, "RECONNECT_JITTER", RECONNECT_JITTER
+        )
+
+        self.resume_on_reconnect = getattr(
+            config, "RESUME_ON_RECONNECT", RESUME_ON_RECONNECT
+        )
+        self.resume_max_rooms = getattr(config, "RESUME_MAX_ROOMS", RESUME_MAX_ROOMS)
+        self.resume_max_messages = getattr(
+            config, "RESUME_MAX_MESSAGES", RESUME_MAX_MESSAGES
+        )
+        self.resume_concurrency = getattr(
+            config, "RESUME_CONCURRENCY", RESUME_CONCURRENCY
+        )
+        self.resume_max_age = getattr(config, "RESUME_MAX_AGE", RESUME_MAX_AGE)
+        self._room_positions_lock = threading.Lock()
+
+        self.async_transport = None
+        self._loop = None
+        self._loop_thread = None
+        if getattr(config, "ASYNC_HTTP", ASYNC_HTTP):
+            try:
+                self.async_transport = AsyncWebexTransport(
+                    access_token=self._bot_token,
+                    pool_size=getattr(
+                        config, "ASYNC_HTTP_POOL_SIZE", ASYNC_HTTP_POOL_SIZE
+                    ),
+                    metrics=self.metrics,
+                )
+            except ImportError:
+                log.fatal("ASYNC_HTTP requires the aiohttp package to be installed.")
+                sys.exit(1)
+
+        self.dispatcher = WebsocketDispatcher(
+            handler=(
+                self.aprocess_websocket
+                if self.async_transport
+                else self.process_identity_websocket
+            ),
+            workers=getattr(
+                config, "WEBSOCKET_DISPATCH_WORKERS", WEBSOCKET_DISPATCH_WORKERS
+            ),
+            queue_size=getattr(
+                config, "WEBSOCKET_DISPATCH_QUEUE_SIZE", WEBSOCKET_DISPATCH_QUEUE_SIZE
+            ),
+            ordered=getattr(
+                config, "WEBSOCKET_DISPATCH_ORDERED", WEBSOCKET_DISPATCH_ORDERED
+            ),
+            room_queue_size=getattr(
+                config,
+                "WEBSOCKET_DISPATCH_ROOM_QUEUE_SIZE",
+                WEBSOCKET_DISPATCH_ROOM_QUEUE_SIZE,
+            ),
         )
 
-        log.debug(f"Done! I'm connected as {self.bot_identifier.email}")
+        outbound_settings = dict(
+            workers=getattr(config, "OUTBOUND_WORKERS", OUTBOUND_WORKERS),
+            room_rate=getattr(config, "OUTBOUND_ROOM_RATE", OUTBOUND_ROOM_RATE),
+            room_burst=getattr(config, "OUTBOUND_ROOM_BURST", OUTBOUND_ROOM_BURST),
+            global_rate=getattr(config, "OUTBOUND_GLOBAL_RATE", OUTBOUND_GLOBAL_RATE),
+            global_burst=getattr(
+                config, "OUTBOUND_GLOBAL_BURST", OUTBOUND_GLOBAL_BURST
+            ),
+        )
+
+        self.outbound = None
+        if getattr(config, "OUTBOUND_QUEUE", OUTBOUND_QUEUE):
+            self.outbound = OutboundScheduler(**outbound_settings)
+
+        # Bulk sends are always throttled, sharing the outbound queue when it is enabled.
+        # The worker threads are only started by the first bulk send.
+        self.bulk_outbound = self.outbound or OutboundScheduler(**outbound_settings)
+
+        upload_concurrency = getattr(config, "UPLOAD_CONCURRENCY", UPLOAD_CONCURRENCY)
+        self.upload_executor = None
+        if upload_concurrency > 1:
+            self.upload_executor = ThreadPoolExecutor(
+                max_workers=upload_concurrency, thread_name_prefix="webex-upload"
+            )
+
+        self.startup_timings = {}
+
+        self._register_metrics()
+
+        log.debug("Setting up WebexAPI")
+        self._active_identity = threading.local()
+        http_adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=getattr(config, "HTTP_POOL_SIZE", HTTP_POOL_SIZE)
+        )
+        self.identities = [
+            CiscoWebexTeamsIdentity(self, token, http_adapter)
+            for token in [self._bot_token]
+            + list(bot_identity.get("ADDITIONAL_TOKENS", []))
+        ]
+
+        self.device_cleanup = getattr(config, "DEVICE_CLEANUP", DEVICE_CLEANUP)
+        self._storage_ready = False
+
+        # Created once the backend storage has been opened
+        self.keyed_store = None
+
+        # The bot's own identities are fetched in the background, concurrently with the device
+        # setup once the backend storage is available (see _setup_devices)
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="webex-startup")
+        self._identities_setup = executor.submit(self._setup_identities)
+        executor.shutdown(wait=False)
 
         self._register_identifiers_pickling()
 
+    def _setup_identities(self):
+        """
+        Fetch and build the identifier of the bot itself for every identity, concurrently
+        """
+        log.debug("Fetching and building identifier for the bot itself.")
+        with self.startup_phase("identities"):
+            with ThreadPoolExecutor(max_workers=len(self.identities)) as executor:
+                people = list(
+                    executor.map(
+                        lambda identity: identity.api.people.me(), self.identities
+                    )
+                )
+
+        for identity, person in zip(self.identities, people):
+            with self.identity_context(identity):
+                identity.bot_identifier = CiscoWebexTeamsPerson(self, person)
+            identity.bot_uuid = self.parse_hydra_id(identity.bot_identifier.id)
+
+            log.debug(f"Done! I'm connected as {identity.email}")
+
+        self.bot_identifier = self.identities[0].bot_identifier
+        self.bot_emails = {
+            email
+            for identity in self.identities
+            for email in identity.bot_identifier.emails
+        }
+        self.bot_uuids = {identity.bot_uuid for identity in self.identities}
+
     @property
     def mode(self):
         return "CiscoWebexTeams"
 
+    @property
+    def active_identity(self):
+        """
+        The identity currently being served on this thread (the primary identity by default)
+        """
+        return getattr(self._active_identity, "identity", None) or self.identities[0]
+
+    @property
+    def webex_teams_api(self):
+        """
+        The WebexAPI of the identity currently being served on this thread
+        """
+        return self.active_identity.api
+
+    @property
+    def room_index(self):
+        """
+        The room title index of the identity currently being served on this thread
+        """
+        return self.active_identity.room_index
+
+    @contextmanager
+    def identity_context(self, identity):
+        """
+        Serve an identity on the current thread for the duration of the context
+        :param identity: A CiscoWebexTeamsIdentity
+        """
+        previous = getattr(self._active_identity, "identity", None)
+        self._active_identity.identity = identity
+        try:
+            yield identity
+        finally:
+            self._active_identity.identity = previous
+
+    def run_as_identity(self, identity, fn, *args):
+        """
+        Call fn while serving the given identity
+        """
+        with self.identity_context(identity):
+            return fn(*args)
+
+    def get_identity(self, email=None):
+        """
+        Return the identity with the given email address. Without an email address the identity
+        currently being served (for example, by a card callback) is returned, and the primary
+        identity is returned if the email address is not found.
+        :param email: The email address of the bot identity
+        """
+        if email is None:
+            return self.active_identity
+
+        for identity in self.identities:
+            if identity.email == email:
+                return identity
+
+        return self.identities[0]
+
+    def get_identifier_identity(self, identifier):
+        """
+        Return the identity that built a person or room, which is the identity that can see it.
+        The identity currently being served is returned for anything else.
+        :param identifier: A person, room or room occupant identifier
+        """
+        return getattr(identifier, "_identity", None) or self.active_identity
+
+    def get_message_identity(self, mess):
+        """
+        Return the identity to send a message as: the identity named by the message, otherwise
+        the identity that built its target (or its sender, for replies), and only otherwise the
+        identity currently being served. Plugins usually send from errbot's command threads,
+        which are not serving any identity.
+        :param mess: A CiscoWebexTeamsMessage
+        """
+        email = mess.extras.get("identity")
+        if email is not None:
+            return self.get_identity(email)
+
+        for identifier in (mess.to, mess.frm):
+            identity = getattr(identifier, "_identity", None)
+            if identity is not None:
+                return identity
+
+        return self.active_identity
+
     def is_from_self(self, message):
         return message.frm.id == message.to.id
 
+    def cache_person(self, person):
+        """
+        Add a Webex Teams person to the person cache, keyed by both ID and email address
+        :param person: A webexpythonsdk.Person
+        """
+        self.person_cache.set(f"id:{person.id}", person)
+        for email in person.emails or []:
+            self.person_cache.set(f"email:{email}", person)
+
+    def invalidate_person_cache(self, id_or_email=None):
+        """
+        Remove a person from the person cache, or clear the cache if no person is provided
+        :param id_or_email: The Webex Teams ID or email address of the person
+        """
+        if id_or_email is None:
+            self.person_cache.invalidate()
+            return
+
+        person = self.person_cache.get(f"id:{id_or_email}") or self.person_cache.get(
+            f"email:{id_or_email}"
+        )
+        if person is None:
+            return
+
+        self.person_cache.invalidate(f"id:{person.id}")
+        for email in person.emails or []:
+            self.person_cache.invalidate(f"email:{email}")
+
     def process_websocket(self, message):
         """
         Process the data from the websocket and determine if we need to ack on it
-        :param message: The message received from the websocket
+        :param message: The message received from the websocket (raw or already decoded)
         :return:
         """
-        message = json.loads(message.decode("utf-8"))
+        if isinstance(message, (bytes, str)):
+            message = json.loads(message)
+
         if message["data"]["eventType"] != "conversation.activity":
             logging.debug(
                 "Ignoring message where Event Type is not conversation.activity"
             )
+            self.metrics.inc(
+                "webex_websocket_frames_ignored_total", reason="event_type"
+            )
             return
 
         activity = message["data"]["activity"]
         new_message = None
 
+        if not self.is_new_activity(activity):
+            self.metrics.inc("webex_websocket_frames_ignored_total", reason="duplicate")
+            return
+
+        if activity["verb"] in ROOM_ACTIVITY_VERBS:
+            self.process_room_activity(activity)
+            return
+
         if activity["verb"] == "post":
+            if not self.is_activity_permitted(activity):
+                self.metrics.inc(
+                    "webex_websocket_frames_ignored_total", reason="not_permitted"
+                )
+                return
+
             new_message = self.webex_teams_api.messages.get(
                 self.build_hydra_id(activity["id"])
             )
+            self.handle_message(new_message)
+            return
 
-            if new_message.personEmail in self.bot_identifier.emails:
-                logging.debug("Ignoring message from myself")
-                return
+        if activity["verb"] == "cardAction":
+            new_message = self.webex_teams_api.attachment_actions.get(
+                self.build_hydra_id(
+                    activity["id"], message_type=HydraTypes.ATTACHMENT_ACTION.value
+                )
+            )
 
-            if (
-                self.permitted_domains
-                and new_message.personEmail.split("@")[1] not in self.permitted_domains
+            # When a cardAction is sent it includes the messageId of the message from which
+            # the card triggered the action, but includes no parentId that we need to be able
+            # to remain within a thread. Unless the bot recorded the parentID when it sent the
+            # card, we need to take the messageID and lookup the details of the message.
+            sent = self.sent_messages.get(new_message.messageId)
+            if sent is None:
+                reply_message = self.webex_teams_api.messages.get(new_message.messageId)
+                sent = (reply_message.parentId, reply_message.roomType)
+
+            self.handle_card_action(new_message, *sent)
+            return
+
+        if not new_message:
+            logging.debug(
+                f'Ignoring message where the verb is not type "post" or "cardAction". Verb is {activity["verb"]}'
+            )
+            self.metrics.inc("webex_websocket_frames_ignored_total", reason="verb")
+
+    def process_identity_websocket(self, message, identity):
+        """
+        Process the data from the websocket of a specific identity
+        :param message: The message received from the websocket (raw or already decoded)
+        :param identity: The CiscoWebexTeamsIdentity whose websocket received the message
+        """
+        with self.identity_context(identity):
+            with self.metrics.timer(
+                "webex_websocket_process_seconds", verb=self.get_event_verb(message)
             ):
-                logging.debug(
-                    f"Ignoring message from `{new_message.personEmail}` "
-                    f"as not in permitted domains `{self.permitted_domains}`"
+                self.process_websocket(message)
+
+    async def aprocess_websocket(self, message, identity):
+        """
+        Process the data from the websocket using the async transport. The Webex Teams API calls are
+        awaited on the event loop and only the plugin callbacks are handed to a worker thread.
+        :param message: The message received from the websocket (raw or already decoded)
+        :param identity: The CiscoWebexTeamsIdentity whose websocket received the message
+        :return:
+        """
+        if isinstance(message, (bytes, str)):
+            message = json.loads(message)
+
+        with self.metrics.timer(
+            "webex_websocket_process_seconds", verb=self.get_event_verb(message)
+        ):
+            await self._aprocess_websocket(message, identity)
+
+    async def _aprocess_websocket(self, message, identity):
+        loop = asyncio.get_event_loop()
+
+        if message["data"]["eventType"] != "conversation.activity":
+            logging.debug(
+                "Ignoring message where Event Type is not conversation.activity"
+            )
+            self.metrics.inc(
+                "webex_websocket_frames_ignored_total", reason="event_type"
+            )
+            return
+
+        activity = message["data"]["activity"]
+
+        with self.identity_context(identity):
+            if not self.is_new_activity(activity):
+                self.metrics.inc(
+                    "webex_websocket_frames_ignored_total", reason="duplicate"
+                )
+                return
+
+        if activity["verb"] in ROOM_ACTIVITY_VERBS:
+            await loop.run_in_executor(
+                None,
+                self.run_as_identity,
+                identity,
+                self.process_room_activity,
+                activity,
+            )
+            return
+
+        if activity["verb"] == "post":
+            if not self.is_activity_permitted(activity):
+                self.metrics.inc(
+                    "webex_websocket_frames_ignored_total", reason="not_permitted"
+                )
+                return
+
+            new_message = await self.async_transport.get_message(
+                self.build_hydra_id(activity["id"]), token=identity.token
+            )
+            await self.aload_room(new_message.roomId, token=identity.token)
+            await loop.run_in_executor(
+                None, self.run_as_identity, identity, self.handle_message, new_message
+            )
+            return
+
+        if activity["verb"] == "cardAction":
+            new_message = await self.async_transport.get_attachment_action(
+                self.build_hydra_id(
+                    activity["id"], message_type=HydraTypes.ATTACHMENT_ACTION.value
+                ),
+                token=identity.token,
+            )
+            sent = self.sent_messages.get(new_message.messageId)
+            if sent is None:
+                reply_message, _ = await asyncio.gather(
+                    self.async_transport.get_message(
+                        new_message.messageId, token=identity.token
+                    ),
+                    self.aload_person(new_message.personId, token=identity.token),
+                )
+                sent = (reply_message.parentId, reply_message.roomType)
+            else:
+                await self.aload_person(new_message.personId, token=identity.token)
+
+            await loop.run_in_executor(
+                None,
+                self.run_as_identity,
+                identity,
+                self.handle_card_action,
+                new_message,
+                *sent,
+            )
+            return
+
+        logging.debug(
+            f'Ignoring message where the verb is not type "post" or "cardAction". Verb is {activity["verb"]}'
+        )
+        self.metrics.inc("webex_websocket_frames_ignored_total", reason="verb")
+
+    async def aload_room(self, room_id, token=None):
+        """
+        Load a room into the room cache using the async transport
+        :param room_id: The ID of the room
+        :param token: The bot token to load the room with, if not the default
+        """
+        if self.room_cache.get(room_id) is not None:
+            return
+
+        try:
+            self.room_cache.set(
+                room_id, await self.async_transport.get_room(room_id, token=token)
+            )
+        except AsyncWebexApiError:
+            log.debug(f"Could not load room {room_id} using the async transport")
+
+    async def aload_person(self, person_id, token=None):
+        """
+        Load a person into the person cache using the async transport
+        :param person_id: The ID of the person
+        :param token: The bot token to load the person with, if not the default
+        """
+        if self.person_cache.get(f"id:{person_id}") is not None:
+            return
+
+        try:
+            self.cache_person(
+                await self.async_transport.get_person(person_id, token=token)
+            )
+        except AsyncWebexApiError:
+            log.debug(f"Could not load person {person_id} using the async transport")
+
+    def is_new_activity(self, activity):
+        """
+        Check that an activity has not already been received. Webex can deliver the same activity
+        again after the websocket reconnects, and every bot identity receives its own copy.
+        :param activity: The activity received from the websocket
+        :return: False if the activity is a duplicate and should be dropped
+        """
+        key = f"{self.active_identity.bot_uuid}:{activity['id']}"
+        if self.seen_activities.add(key):
+            return True
+
+        logging.debug(f"Ignoring activity {activity['id']} as already received")
+        return False
+
+    def handle_message(self, new_message):
+        """
+        Drop messages from the bot itself or from outside the permitted domains, and pass
+        the remainder to errbot
+        :param new_message: A webexpythonsdk.Message
+        """
+        if not self.seen_messages.add(
+            f"{self.active_identity.bot_uuid}:{new_message.id}"
+        ):
+            logging.debug(f"Ignoring message {new_message.id} as already processed")
+            return
+
+        self.advance_room_position(new_message)
+
+        if new_message.personEmail in self.bot_emails:
+            logging.debug("Ignoring message from myself")
+            return
+
+        if (
+            self.permitted_domains
+            and new_message.personEmail.split("@")[1] not in self.permitted_domains
+        ):
+            logging.debug(
+                f"Ignoring message from `{new_message.personEmail}` "
+                f"as not in permitted domains `{self.permitted_domains}`"
+            )
+            return
+
+        logging.info(f"Message from {new_message.personEmail}: {new_message.text}\n")
+
+        self.callback_message(self.get_message(new_message))
+
+    def advance_room_position(self, message):
+        """
+        Record a message as the last processed in its room for the current identity, unless a
+        newer message has already been processed (for example, a live message received while
+        older missed messages are being replayed)
+        :param message: A webexpythonsdk.Message
+        """
+        positions = self.active_identity.room_positions
+        with self._room_positions_lock:
+            position = positions.get(message.roomId)
+            if position is None or message.created > position[0]:
+                positions.set(
+                    message.roomId, (message.created, message.id, message.roomType)
                 )
+
+    def resume(self):
+        """
+        Fetch the messages missed by the current identity while its websocket was disconnected (or
+        the bot was stopped), for each room a message has been received from, and process them in order
+        """
+        identity = self.active_identity
+        positions = identity.room_positions.items()
+        if not positions:
+            return
+
+        log.info(
+            f"Resuming {len(positions)} rooms for {identity.email} after connecting"
+        )
+
+        with ThreadPoolExecutor(max_workers=self.resume_concurrency) as executor:
+            missed = executor.map(
+                lambda position: self.run_as_identity(
+                    identity, self._get_missed_messages, *position
+                ),
+                positions,
+            )
+
+            for room_id, messages in zip((room_id for room_id, _ in positions), missed):
+                if messages:
+                    log.info(f"Replaying {len(messages)} missed messages from {room_id}")
+
+                for message in messages:
+                    # The activities received before a restart are persisted, unlike the
+                    # processed messages, so commands handled just before it are not run again
+                    key = f"{identity.bot_uuid}:{self.parse_hydra_id(message.id)}"
+                    if not self.seen_activities.add(key):
+                        log.debug(
+                            f"Not replaying message {message.id} as already received"
+                        )
+                        continue
+
+                    # noinspection PyBroadException
+                    try:
+                        self.handle_message(message)
+                    except Exception:
+                        log.exception(f"Failed to replay message {message.id}")
+
+    def _get_missed_messages(self, room_id, position):
+        """
+        Page back through the messages of a room until the last processed message is reached
+        :param room_id: The ID of the room
+        :param position: The (created, id, roomType) of the last processed message
+        :return: The missed messages, oldest first
+        """
+        created, message_id, room_type = position
+
+        params = {"roomId": room_id, "max": min(self.resume_max_messages, 100)}
+        if room_type == "group":
+            # Bots can only list the messages that mention them in group rooms
+            params["mentionedPeople"] = "me"
+
+        missed = []
+        oldest = None
+        if self.resume_max_age:
+            oldest = datetime.now(timezone.utc) - timedelta(seconds=self.resume_max_age)
+
+        try:
+            for message in self.webex_teams_api.messages.list(**params):
+                if message.id == message_id or message.created <= created:
+                    break
+
+                if oldest is not None and message.created < oldest:
+                    log.info(
+                        f"Not replaying messages from {room_id} older than "
+                        f"{self.resume_max_age} seconds"
+                    )
+                    break
+
+                missed.append(message)
+
+                if len(missed) >= self.resume_max_messages:
+                    log.warning(
+                        f"Only replaying the last {self.resume_max_messages} messages from {room_id}"
+                    )
+                    break
+        except webexpythonsdk.exceptions.ApiError:
+            log.exception(f"Failed to fetch missed messages from {room_id}")
+
+        return list(reversed(missed))
+
+    def handle_card_action(self, new_message, parent_id, room_type=None):
+        """
+        Pass a card action to the plugins
+        :param new_message: A webexpythonsdk.AttachmentAction
+        :param parent_id: The parentId of the message that contained the card
+        :param room_type: The type of the room, if known
+        """
+        new_message.parentId = parent_id
+        self.callback_card(
+            self.get_card_message(new_message, room_type=room_type),
+            new_message.inputs.get("_callback_card"),
+        )
+
+    @staticmethod
+    def get_event_verb(event):
+        """
+        Return the verb of the activity of a websocket event, used to label its metrics
+        :param event: The decoded event received from the websocket
+        """
+        if not isinstance(event, dict):
+            return "unknown"
+
+        data = event.get("data") or {}
+        activity = data.get("activity") or {}
+        return activity.get("verb") or data.get("eventType") or "unknown"
+
+    @staticmethod
+    def get_event_room_key(event):
+        """
+        Determine the key used to keep the events of a room in order when dispatching
+        :param event: The decoded websocket event
+        :return: The ID of the conversation the event relates to, if any
+        """
+        activity = (event.get("data") or {}).get("activity") or {}
+        return (activity.get("target") or {}).get("id")
+
+    def is_activity_permitted(self, activity):
+        """
+        Use the actor of an activity to discard messages from the bot itself, or from people outside
+        of the permitted domains, before making any calls to the Webex Teams API.
+
+        The content of the activity is encrypted so the message itself still has to be fetched
+        for any activity that passes this check.
+
+        :param activity: The activity received from the websocket
+        :return: False if the activity should be ignored
+        """
+        actor = activity.get("actor") or {}
+        email = actor.get("emailAddress")
+
+        if email in self.bot_emails or actor.get("entryUUID") in self.bot_uuids:
+            logging.debug("Ignoring activity from myself")
+            return False
+
+        if (
+            email
+            and self.permitted_domains
+            and email.split("@")[-1] not in self.permitted_domains
+        ):
+            logging.debug(
+                f"Ignoring activity from `{email}` "
+                f"as not in permitted domains `{self.permitted_domains}`"
+            )
+            return False
+
+        return True
+
+    def process_room_activity(self, activity):
+        """
+        Membership or metadata of a room has changed. Membership changes update the membership
+        index, and only when the membership of the bot itself changes, or the room is updated,
+        locked or unlocked, is the cached room dropped and reloaded into the room title index.
+        :param activity: The activity received from the websocket
+        """
+        room_id = self.get_activity_room_id(activity)
+        if not room_id:
+            return
+
+        if activity["verb"] in ("add", "leave"):
+            self.update_membership_index(room_id, activity)
+
+            person = activity.get("object") or {}
+            if person.get("id") not in self.bot_uuids:
                 return
 
-            logging.info(
-                f"Message from {new_message.personEmail}: {new_message.text}\n"
-            )
+        logging.debug(
+            f'Invalidating cached room {room_id} after "{activity["verb"]}" activity'
+        )
+        self.room_cache.invalidate(room_id)
+        self.room_index.refresh(room_id)
 
-            self.callback_message(self.get_message(new_message))
+    def update_membership_index(self, room_id, activity):
+        """
+        Apply a membership change received over the websocket to the membership index
+        :param room_id: The ID of the room
+        :param activity: The add or leave activity received from the websocket
+        """
+        person = activity.get("object") or {}
+        if person.get("objectType") != "person" or not person.get("id"):
+            self.membership_index.invalidate(room_id)
             return
 
-        if activity["verb"] == "cardAction":
-            new_message = self.webex_teams_api.attachment_actions.get(
-                self.build_hydra_id(
-                    activity["id"], message_type=HydraTypes.ATTACHMENT_ACTION.value
-                )
+        if activity["verb"] == "leave":
+            self.membership_index.remove(room_id, person["id"])
+        elif person.get("emailAddress"):
+            self.membership_index.add(
+                room_id,
+                person["id"],
+                self.build_hydra_id(person["id"], message_type=HydraTypes.PEOPLE.value),
+                person["emailAddress"],
             )
-            callback_card = new_message.inputs.get("_callback_card")
-
-            # When a cardAction is sent it includes the messageId of the message from which
-            # the card triggered the action, but includes no parentId that we need to be able
-            # to remain within a thread. So we need to take the messageID and lookup the details
-            # of the message to be ble to determine the parentID.
-            reply_message = self.webex_teams_api.messages.get(new_message.messageId)
-            new_message.parentId = reply_message.parentId
+        else:
+            self.membership_index.invalidate(room_id)
 
-            self.callback_card(self.get_card_message(new_message), callback_card)
-            return
+    def get_activity_room_id(self, activity):
+        """
+        Determine the ID of the room (conversation) that an activity relates to
+        :param activity: The activity received from the websocket
+        :return: The Hydra ID of the room or None if the activity does not relate to a room
+        """
+        for field in ("target", "object"):
+            item = activity.get(field) or {}
+            if item.get("objectType") == "conversation" and item.get("id"):
+                return self.build_hydra_id(
+                    item["id"], message_type=HydraTypes.ROOM.value
+                )
 
-        if not new_message:
-            logging.debug(
-                f'Ignoring message where the verb is not type "post" or "cardAction". Verb is {activity["verb"]}'
-            )
+        return None
 
     def callback_card(self, message, callback_card):
         """
@@ -564,27 +3614,34 @@ class CiscoWebexTeamsBackend(ErrBot):
         :param message: Message to be processed
         :param callback_card: Function to trigger
         """
+        # A card naming its callback (with a _callback_card input) is only handled by that
+        # callback, so a loosely matching @card_action route can not take over another
+        # plugin's cards. Otherwise routed handlers take precedence over callback_card.
+        handlers = None
         if not callback_card:
+            handlers = self.callbacks.card_routes(message.card_action.inputs)
             callback_card = "callback_card"
 
-        for plugin in self.plugin_manager.get_all_active_plugins():
-            plugin_name = plugin.name
+        if not handlers:
+            # As this is a custom callback specific to this backend, there is no
+            # expectation that all plugins with have implemented this method
+            handlers = self.callbacks.handlers(callback_card)
+
+        for plugin_name, handler in handlers:
             log.debug(
-                f"Triggering {callback_card} on {plugin_name}.",
+                f"Triggering {handler.__name__} on {plugin_name}.",
             )
             # noinspection PyBroadException
             try:
-                # As this is a custom callback specific to this backend, there is no
-                # expectation that all plugins with have implemented this method
-                if hasattr(plugin, callback_card):
-                    getattr(plugin, callback_card)(message)
+                handler(message)
             except Exception:
-                log.exception(f"{callback_card} on {plugin_name} crashed.")
+                log.exception(f"{handler.__name__} on {plugin_name} crashed.")
 
-    def get_card_message(self, message):
+    def get_card_message(self, message, room_type=None):
         """
         Create an errbot message object with attached card
         :param message: Message to be processed
+        :param room_type: The type of the room, if known
         :return:
         """
 
@@ -597,7 +3654,9 @@ class CiscoWebexTeamsBackend(ErrBot):
         except AttributeError:
             parent_id = message.id
 
-        card_room = CiscoWebexTeamsRoom(backend=self, room_id=message.roomId)
+        card_room = CiscoWebexTeamsRoom(
+            backend=self, room_id=message.roomId, room_type=room_type
+        )
         card_occupant = CiscoWebexTeamsRoomOccupant(
             self, person=card_person, room=card_room
         )
@@ -607,7 +3666,11 @@ class CiscoWebexTeamsBackend(ErrBot):
             frm=card_occupant,
             to=card_room,
             parent=parent_id,
-            extras={"roomType": card_room.type, "message_id": message.id},
+            extras={
+                "roomType": card_room.type,
+                "message_id": message.id,
+                "identity": self.active_identity.email,
+            },
         )
         card_msg.card_action = message
 
@@ -633,14 +3696,20 @@ class CiscoWebexTeamsBackend(ErrBot):
         except AttributeError:
             parent_id = message.id
 
-        room = CiscoWebexTeamsRoom(backend=self, room_id=message.roomId)
+        room = CiscoWebexTeamsRoom(
+            backend=self, room_id=message.roomId, room_type=message.roomType
+        )
         occupant = CiscoWebexTeamsRoomOccupant(self, person=person, room=room)
         msg = CiscoWebexTeamsMessage(
             body=message.markdown or message.text,
             frm=occupant,
             to=room,
             parent=parent_id,
-            extras={"roomType": message.roomType, "message_id": message.id},
+            extras={
+                "roomType": message.roomType,
+                "message_id": message.id,
+                "identity": self.active_identity.email,
+            },
         )
         return msg
 
@@ -714,6 +3783,11 @@ class CiscoWebexTeamsBackend(ErrBot):
 
         """
 
+        identity = self.get_message_identity(mess)
+        if identity is not self.active_identity:
+            with self.identity_context(identity):
+                return self.send_message(mess)
+
         if not hasattr(mess, "card"):
             mess.card = None
 
@@ -742,6 +3816,10 @@ class CiscoWebexTeamsBackend(ErrBot):
         # Webex teams does not support more than one file in a single message
         # so lets hide this shortcoming here by creating multiple separate messages
         if mess.files and len(mess.files) > 1:
+            if self.upload_executor and not self.outbound:
+                self.send_files_concurrently(mess)
+                return
+
             new_msg = copy(mess)
 
             for file in mess.files:
@@ -752,17 +3830,10 @@ class CiscoWebexTeamsBackend(ErrBot):
 
         md = None
         if mess.body:
-            # Need to strip out "markdown extra" as not supported by Webex Teams
-            md = markdown(
-                self.md.convert(mess.body),
-                extensions=[
-                    "markdown.extensions.nl2br",
-                    "markdown.extensions.fenced_code",
-                ],
-            )
+            md = self.renderer.render(mess.body)
 
         if type(mess.to) == CiscoWebexTeamsPerson:
-            self.webex_teams_api.messages.create(
+            self.deliver_message(
                 toPersonId=mess.to.id,
                 text=mess.body,
                 markdown=md,
@@ -772,35 +3843,344 @@ class CiscoWebexTeamsBackend(ErrBot):
             )
             return
 
-        self.callback_send_message(
-            self.webex_teams_api.messages.create(
-                roomId=mess.to.room.id,
-                text=mess.body,
-                markdown=md,
-                parentId=mess.parent,
-                attachments=mess.card,
-                files=mess.files,
+        if isinstance(mess.to, CiscoWebexTeamsRoom):
+            room_id = mess.to.id
+        else:
+            room_id = mess.to.room_id
+
+        self.deliver_message(
+            callback=self.callback_send_message,
+            roomId=room_id,
+            text=mess.body,
+            markdown=md,
+            parentId=mess.parent,
+            attachments=mess.card,
+            files=mess.files,
+        )
+
+    def send_bulk(self, targets, body=None, card=None, files=None, identity=None):
+        """
+        Send the same content to many rooms and people. The body is rendered and local files are
+        read only once, and the messages are sent concurrently through the outbound scheduler so
+        that they are throttled per target and globally, and retried when rate limited.
+
+        :param targets: The rooms and people to send to. Each is a CiscoWebexTeamsRoom,
+            CiscoWebexTeamsPerson, an email address or a room ID
+        :param body: The markdown body of the message
+        :param card: A card (or list of cards) to attach to the message
+        :param files: A file (or list of files) to send, each a path, URL or binary file object
+        :param identity: The email address of the bot identity to send as, if not the default
+        :return: A list of BulkSendResult, in the same order as the targets
+        """
+        if not isinstance(card, list) and card is not None:
+            card = [card]
+
+        if not isinstance(files, list) and files is not None:
+            files = [files]
+
+        # Webex Teams does not support a message containing both text and a file, or more than
+        # one file, so each target receives the body (and card) followed by one message per file
+        contents = []
+        if body or card:
+            contents.append(
+                dict(
+                    text=body,
+                    markdown=self.renderer.render(body) if body else None,
+                    attachments=card,
+                )
+            )
+
+        for file in files or []:
+            if isinstance(file, str) and is_web_url(file):
+                contents.append(dict(files=[file]))
+                continue
+
+            if isinstance(file, (str, os.PathLike)):
+                name = os.path.basename(file)
+                with open(file, "rb") as file_object:
+                    data = file_object.read()
+            else:
+                name = os.path.basename(getattr(file, "name", ""))
+                data = file.read()
+            contents.append(dict(file_data=data, name=name or "file"))
+
+        api = self.get_identity(identity).outbound_api
+        results = []
+        futures = []
+
+        for target in targets:
+            result = BulkSendResult(target)
+            results.append(result)
+
+            try:
+                destination = self._bulk_destination(target)
+            except Exception as error:
+                result.error = error
+                continue
+
+            for content in contents:
+                futures.append(
+                    (
+                        result,
+                        self.bulk_outbound.submit(
+                            next(iter(destination.values())),
+                            self._send_bulk_content,
+                            api,
+                            content,
+                            destination,
+                        ),
+                    )
+                )
+
+        for result, future in futures:
+            try:
+                result.message_ids.append(future.result().id)
+            except Exception as error:
+                result.error = result.error or error
+
+        return results
+
+    def _send_bulk_content(self, api, content, destination):
+        """
+        Create one of the messages of a bulk send
+        :param api: The WebexAPI used to create the message
+        :param content: The prepared content of the message
+        :param destination: The roomId, toPersonId or toPersonEmail of the message
+        :return: The webexpythonsdk.Message that was created
+        """
+        if "file_data" in content:
+            return self.create_file_message(
+                io.BytesIO(content["file_data"]),
+                name=content["name"],
+                api=api,
+                **destination,
+            )
+
+        return self.create_message(api=api, **destination, **content)
+
+    @staticmethod
+    def _bulk_destination(target):
+        """
+        Return the message parameters that address a target of a bulk send
+        :param target: A CiscoWebexTeamsRoom, CiscoWebexTeamsPerson, email address or room ID
+        """
+        if isinstance(target, CiscoWebexTeamsRoom):
+            return {"roomId": target.id}
+
+        if isinstance(target, CiscoWebexTeamsPerson):
+            return {"toPersonId": target.id}
+
+        if isinstance(target, str) and "@" in target:
+            return {"toPersonEmail": target}
+
+        if isinstance(target, str):
+            return {"roomId": target}
+
+        raise ValueError(f"Unable to send to {target!r}")
+
+    def send_files_concurrently(self, mess):
+        """
+        Send each file of a message as a separate message, uploading up to UPLOAD_CONCURRENCY
+        files at the same time. Returns once every upload has completed, raising the first
+        failure (in the order the files were provided).
+
+        :param mess: A CiscoWebexTeamsMessage with more than one file
+        """
+        # The upload threads are not serving any identity
+        identity = self.get_message_identity(mess)
+        futures = []
+
+        for file in mess.files:
+            new_msg = copy(mess)
+            new_msg.files = [file]
+            futures.append(
+                self.upload_executor.submit(
+                    self.run_as_identity, identity, self.send_message, new_msg
+                )
+            )
+
+        for future in futures:
+            future.result()
+
+    def deliver_message(self, callback=None, **kwargs):
+        """
+        Create a message in Webex Teams, either immediately or through the outbound scheduler
+        when OUTBOUND_QUEUE is enabled
+        :param callback: Called with the webexpythonsdk.Message once the message has been created
+        """
+        if not self.outbound:
+            message = self.create_message(**kwargs)
+            if callback:
+                callback(message)
+            return
+
+        future = self.outbound.submit(
+            kwargs.get("roomId") or kwargs.get("toPersonId"),
+            self.create_message,
+            api=self.active_identity.outbound_api,
+            **kwargs,
+        )
+        if callback:
+            future.add_done_callback(
+                lambda done: done.exception() is None and callback(done.result())
+            )
+
+    def create_message(self, api=None, **kwargs):
+        """
+        Create a message in Webex Teams. When the async transport is enabled, and the event loop is
+        running, the message is created over the pooled async session instead of webexpythonsdk.
+        :param api: The WebexAPI used to create the message, if not the default
+        :return: The webexpythonsdk.Message that was created
+        """
+        files = kwargs.pop("files", None)
+        if files and not (isinstance(files[0], str) and is_web_url(files[0])):
+            return self.create_file_message(files[0], api=api, **kwargs)
+
+        kwargs["files"] = files
+
+        if (
+            self.async_transport
+            and not kwargs.get("files")
+            and self._loop
+            and self._loop.is_running()
+            and threading.current_thread() is not self._loop_thread
+        ):
+            message = asyncio.run_coroutine_threadsafe(
+                self.async_transport.create_message(
+                    token=(api or self.webex_teams_api).access_token, **kwargs
+                ),
+                self._loop,
+            ).result()
+        else:
+            message = (api or self.webex_teams_api).messages.create(**kwargs)
+
+        if kwargs.get("attachments"):
+            self.sent_messages.set(message.id, (message.parentId, message.roomType))
+
+        return message
+
+    def create_file_message(self, file, name=None, api=None, **kwargs):
+        """
+        Create a message with a single local file attached. The file is streamed as the body of a
+        multipart request, so it is never held in memory in full.
+
+        :param file: The path of the file, or a file object opened in binary mode
+        :param name: The name of the file presented in Webex Teams, if not the name of the file
+        :param api: The WebexAPI used to create the message, if not the default
+        :return: The webexpythonsdk.Message that was created
+        """
+        opened = isinstance(file, (str, os.PathLike))
+        file_object = open(file, "rb") if opened else file
+
+        # Remember where the file starts so that it can be rewound for a retry (for example by
+        # the outbound scheduler after a 429) if the upload fails
+        start = None
+        if not opened and getattr(file_object, "seekable", lambda: False)():
+            start = file_object.tell()
+
+        try:
+            name = name or os.path.basename(getattr(file_object, "name", "")) or "file"
+
+            fields = {
+                key: json.dumps(value) if isinstance(value, (list, dict)) else value
+                for key, value in dict_from_items_with_values(**kwargs).items()
+            }
+            fields["files"] = (
+                name,
+                file_object,
+                mimetypes.guess_type(name)[0] or "application/octet-stream",
             )
+            from requests_toolbelt import MultipartEncoder
+
+            multipart_data = MultipartEncoder(fields=fields)
+
+            with self.metrics.timer("webex_upload_seconds"):
+                message = webexpythonsdk.Message(
+                    (api or self.webex_teams_api)._session.post(
+                        "messages",
+                        data=multipart_data,
+                        headers={"Content-type": multipart_data.content_type},
+                    )
+                )
+            self.metrics.inc("webex_upload_bytes_total", multipart_data.len)
+            return message
+        except Exception:
+            if start is not None:
+                file_object.seek(start)
+            raise
+        finally:
+            if opened:
+                file_object.close()
+
+    def split_and_send_message(self, mess):
+        """
+        Send a message that may be larger than MESSAGE_SIZE_LIMIT as multiple messages, keeping
+        fenced code blocks and tables intact across the pages
+
+        :param mess: The message to be sent
+        """
+        if not mess.body:
+            self.send_message(mess)
+            return
+
+        paginator = MarkdownPaginator(
+            limit=self.message_size_limit,
+            measure=lambda page: max(len(page), len(self.renderer.render(page))),
         )
 
+        for page in paginator.paginate(mess.body):
+            partial_message = mess.clone()
+            partial_message.body = page
+            partial_message.partial = True
+            self.send_message(partial_message)
+
     def callback_send_message(self, message):
         """
-        Send the message to the send message callback if a plugin is listening
+        Send the message to the send message callback if a plugin is listening. When
+        CALLBACK_SEND_MESSAGE_ASYNC is enabled the callbacks are run on the errbot thread pool
+        rather than on the sending thread.
         :param message: The message to send via the callback
         """
-        for plugin in self.plugin_manager.get_all_active_plugins():
+        # As this is a custom callback specific to this backend, there is no
+        # expectation that all plugins with have implemented this method
+        handlers = self.callbacks.handlers("callback_send_message")
+        if not handlers:
+            return
+
+        if self.callback_send_message_async:
+            self.thread_pool.apply_async(
+                self._run_send_message_callbacks, (handlers, message)
+            )
+            return
+
+        self._run_send_message_callbacks(handlers, message)
+
+    @staticmethod
+    def _run_send_message_callbacks(handlers, message):
+        for plugin_name, handler in handlers:
             # noinspection PyBroadException
             try:
-                # As this is a custom callback specific to this backend, there is no
-                # expectation that all plugins with have implemented this method
-                if hasattr(plugin, "callback_send_message"):
-                    log.debug(f"Triggering 'callback_send_message' on {plugin.name}.")
-                    getattr(plugin, "callback_send_message")(message)
+                log.debug(f"Triggering 'callback_send_message' on {plugin_name}.")
+                handler(message)
             except Exception:
                 log.exception(
-                    f"'callback_send_message' on {plugin.name} raised an exception."
+                    f"'callback_send_message' on {plugin_name} raised an exception."
                 )
 
+    def inject_commands_from(self, instance_to_inject):
+        """
+        A plugin has been activated, so rebuild the callback registry on next use
+        """
+        super().inject_commands_from(instance_to_inject)
+        self.callbacks.invalidate()
+
+    def remove_commands_from(self, instance_to_inject):
+        """
+        A plugin has been deactivated, so rebuild the callback registry on next use
+        """
+        super().remove_commands_from(instance_to_inject)
+        self.callbacks.invalidate()
+
     def _teams_upload(self, stream):
         """
         Performs an upload defined in a stream
@@ -814,13 +4194,16 @@ class CiscoWebexTeamsBackend(ErrBot):
                 f"Upload of {stream.raw.name} to {stream.identifier} has started."
             )
 
+            name = os.path.basename(getattr(stream.raw, "name", "")) or stream.name
+            api = self.get_identifier_identity(stream.identifier).api
+
             if type(stream.identifier) == CiscoWebexTeamsPerson:
-                self.webex_teams_api.messages.create(
-                    toPersonId=stream.identifier.id, files=[stream.raw.name]
+                self.create_file_message(
+                    stream.raw, name=name, api=api, toPersonId=stream.identifier.id
                 )
             else:
-                self.webex_teams_api.messages.create(
-                    roomId=stream.identifier.room.id, files=[stream.raw.name]
+                self.create_file_message(
+                    stream.raw, name=name, api=api, roomId=stream.identifier.room.id
                 )
 
             stream.success()
@@ -873,90 +4256,507 @@ class CiscoWebexTeamsBackend(ErrBot):
         if threaded:
             response.parent = mess.parent
 
+        # Reply using the same bot identity that received the message
+        if mess.extras.get("identity"):
+            response.extras["identity"] = mess.extras["identity"]
+
         return response
 
     def disconnect_callback(self):
         """
         Disconnection has been requested, lets make sure we clean up
         """
+        if self._storage_ready and self.seen_activities_persist:
+            self[SEEN_ACTIVITIES_STORAGE_KEY] = self.seen_activities.ids()
+        if self._storage_ready and self.resume_on_reconnect:
+            self[ROOM_POSITIONS_STORAGE_KEY] = {
+                identity.token_hash: identity.room_positions.items()
+                for identity in self.identities
+            }
         super().disconnect_callback()
 
+    def initialize_backend_storage(self):
+        """
+        Open the backend storage, restore the activities already received and the rooms to resume
+        from previous runs and setup the device for each identity, reusing the devices registered by previous runs where possible
+        """
+        super().initialize_backend_storage()
+        self._storage_ready = True
+        self.keyed_store = KeyedStore(
+            self._keyed_storage_engine(),
+            getattr(
+                self.bot_config,
+                "KEYED_STORAGE_FLUSH_INTERVAL",
+                KEYED_STORAGE_FLUSH_INTERVAL,
+            ),
+            getattr(
+                self.bot_config,
+                "KEYED_STORAGE_MAX_RESIDENT",
+                KEYED_STORAGE_MAX_RESIDENT,
+            ),
+        )
+        self.keyed_store.start()
+        if self.seen_activities_persist:
+            self.seen_activities.load(self.get(SEEN_ACTIVITIES_STORAGE_KEY, []))
+        if self.resume_on_reconnect:
+            positions = self.get(ROOM_POSITIONS_STORAGE_KEY, {})
+            for identity in self.identities:
+                for room_id, position in positions.get(identity.token_hash, []):
+                    identity.room_positions.set(room_id, position)
+        self._setup_devices()
+
+    def _keyed_storage_engine(self):
+        """
+        Create the storage engine for remember() and recall() selected by KEYED_STORAGE_ENGINE
+        """
+        engine = getattr(self.bot_config, "KEYED_STORAGE_ENGINE", KEYED_STORAGE_ENGINE)
+
+        if engine == "sqlite":
+            path = getattr(
+                self.bot_config,
+                "KEYED_STORAGE_PATH",
+                os.path.join(self.bot_config.BOT_DATA_DIR, "webex_keyed_storage.db"),
+            )
+            return SQLiteStorageEngine(path)
+
+        if engine != "errbot":
+            log.fatal(f'Unknown KEYED_STORAGE_ENGINE "{engine}"')
+            sys.exit(1)
+
+        return ErrbotStorageEngine(self)
+
+    def close_storage(self):
+        """
+        Write any buffered remember() changes before the backend storage is closed
+        """
+        if self.keyed_store:
+            self.keyed_store.close()
+            self.keyed_store = None
+        self._storage_ready = False
+        super().close_storage()
+
+    def _setup_devices(self):
+        """
+        Setup the device of every identity that does not have one yet, concurrently with (and
+        then waiting for) the fetching of the bot's own identities
+        """
+        identities = [
+            identity for identity in self.identities if identity.device_info is None
+        ]
+
+        if identities:
+            log.debug("Setting up devices on Webex Teams")
+            with self.startup_phase("devices"):
+                with ThreadPoolExecutor(max_workers=len(identities)) as executor:
+                    devices = list(executor.map(self._get_device_info, identities))
+
+            for identity, device in zip(identities, devices):
+                identity.device_info = device
+
+        # Raises if any of the identities could not be fetched
+        self._identities_setup.result()
+
+        if identities:
+            log.info(f"Startup timings (seconds): {self.startup_timings}")
+
+    @contextmanager
+    def startup_phase(self, phase):
+        """
+        Record how long a phase of startup takes in startup_timings
+        :param phase: The name of the phase
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.startup_timings[phase] = round(time.monotonic() - started, 3)
+
     def serve_once(self):
         """
         Signal that we are connected to the Webex Teams Service and hang around waiting for disconnection request
         """
+        self._setup_devices()
+
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
+
+        import websockets
+
         self.connect_callback()
+        self._loop = asyncio.get_event_loop()
+        self._loop_thread = threading.current_thread()
         try:
             while True:
 
-                async def _run():
+                async def _run(identity):
                     logging.debug(
                         "Opening websocket connection to %s"
-                        % self.device_info["webSocketUrl"]
+                        % identity.device_info["webSocketUrl"]
                     )
                     async with websockets.connect(
-                        self.device_info["webSocketUrl"]
+                        identity.device_info["webSocketUrl"],
+                        ping_interval=self.websocket_ping_interval,
+                        ping_timeout=self.websocket_ping_timeout,
                     ) as ws:
-                        logging.info("WebSocket Opened\n")
+                        logging.info(f"WebSocket Opened for {identity.email}\n")
                         msg = {
                             "id": str(uuid.uuid4()),
                             "type": "authorization",
-                            "data": {"token": "Bearer " + self._bot_token},
+                            "data": {"token": "Bearer " + identity.token},
                         }
                         await ws.send(json.dumps(msg))
 
-                        self.reset_reconnection_count()
+                        identity.connected_at = time.monotonic()
+                        self.dispatcher.start()
 
-                        while True:
-                            message = await ws.recv()
-                            logging.debug(
-                                "WebSocket Received Message(raw): %s\n" % message
+                        # Also run on the first connection, to catch up from the positions
+                        # saved by the previous run
+                        if self.resume_on_reconnect:
+                            asyncio.get_event_loop().run_in_executor(
+                                None, self.run_as_identity, identity, self.resume
                             )
+
+                        # The backoff is only reset once the connection has proven to work (a
+                        # frame is received or a keepalive ping is answered), not as soon as it
+                        # opens, so a server accepting and then dropping connections is not
+                        # retried every second
+                        proven = False
+                        last_received = time.monotonic()
+                        while True:
+                            if not proven and ws.latency:
+                                proven = True
+                                self._reset_reconnect_delay(identity)
+
+                            timeout = None
+                            if self.websocket_idle_timeout:
+                                timeout = max(
+                                    0,
+                                    last_received
+                                    + self.websocket_idle_timeout
+                                    - time.monotonic(),
+                                )
+                            if not proven and self.websocket_ping_interval:
+                                # Wake up to check whether a keepalive ping has been answered
+                                timeout = (
+                                    self.websocket_ping_interval
+                                    if timeout is None
+                                    else min(timeout, self.websocket_ping_interval)
+                                )
+
+                            try:
+                                message = await asyncio.wait_for(
+                                    ws.recv(), timeout=timeout
+                                )
+                            except asyncio.TimeoutError:
+                                idle = time.monotonic() - last_received
+                                if (
+                                    not self.websocket_idle_timeout
+                                    or idle < self.websocket_idle_timeout
+                                ):
+                                    continue
+
+                                logging.warning(
+                                    f"Nothing received for {self.websocket_idle_timeout} seconds "
+                                    f"on the websocket for {identity.email}, reconnecting"
+                                )
+                                return True
+                            except websockets.ConnectionClosedOK:
+                                # Closed normally by the server, for example once the connection
+                                # reaches its maximum age
+                                logging.info(
+                                    f"WebSocket for {identity.email} closed by the server"
+                                )
+                                return proven
+
+                            last_received = time.monotonic()
+                            self.metrics.inc("webex_websocket_frames_received_total")
+
+                            if not proven:
+                                proven = True
+                                self._reset_reconnect_delay(identity)
+                            logging.debug("WebSocket Received Message(raw): %s", message)
                             try:
-                                loop = asyncio.get_event_loop()
-                                loop.run_in_executor(
-                                    None, self.process_websocket, message
+                                event = json.loads(message)
+                                self.dispatcher.dispatch(
+                                    self.get_event_room_key(event), event, identity
                                 )
                             except:
+                                self.metrics.inc(
+                                    "webex_websocket_frames_ignored_total",
+                                    reason="invalid",
+                                )
                                 logging.warning(
                                     "An exception occurred while processing message. Ignoring. "
                                 )
 
-                asyncio.get_event_loop().run_until_complete(_run())
+                async def _serve(identity):
+                    # Reconnect the websocket of an identity whenever it closes or fails,
+                    # backing off exponentially (with jitter) between failed attempts. Planned
+                    # reconnects (idle, or closed normally once working) reconnect immediately.
+                    while True:
+                        planned = False
+                        # noinspection PyBroadException
+                        try:
+                            planned = await _run(identity)
+                        except Exception:
+                            logging.exception(f"WebSocket for {identity.email} failed")
+                        finally:
+                            identity.connected_at = None
+
+                        if planned:
+                            identity.reconnects += 1
+                            self._reset_reconnect_delay(identity)
+                            logging.info(f"Reconnecting the websocket for {identity.email}")
+                            continue
+
+                        delay = self._next_reconnect_delay(identity)
+                        logging.info(
+                            f"Reconnecting the websocket for {identity.email} in {delay:.1f} seconds"
+                        )
+                        await asyncio.sleep(delay)
+
+                async def _run_identities():
+                    # Serve every identity on this event loop, each reconnecting independently
+                    await asyncio.gather(
+                        *(_serve(identity) for identity in self.identities)
+                    )
+
+                self._loop.run_until_complete(_run_identities())
         except KeyboardInterrupt:
             log.info("Interrupt received, shutting down..")
             return True
         finally:
+            if self.async_transport:
+                self._loop.run_until_complete(self.async_transport.close())
             self.disconnect_callback()
 
+    def _reset_reconnect_delay(self, identity):
+        """
+        Reset the backoff of an identity once its websocket is known to be working
+        :param identity: The CiscoWebexTeamsIdentity
+        """
+        self.reset_reconnection_count()
+        identity.reconnect_delay = 1
+
+    def _next_reconnect_delay(self, identity):
+        """
+        Return how long to wait before reconnecting the websocket of an identity, and back off
+        the delay for the next attempt in the same way as errbot
+        :param identity: The CiscoWebexTeamsIdentity that is reconnecting
+        :return: The delay in seconds
+        """
+        delay = identity.reconnect_delay
+        identity.reconnects += 1
+        self._reconnection_count += 1
+
+        identity.reconnect_delay = min(
+            identity.reconnect_delay * self._reconnection_multiplier,
+            self._reconnection_max_delay,
+        ) + random.uniform(*self._reconnection_jitter)
+
+        return delay
+
+    def _register_metrics(self):
+        """
+        Define the metrics of the backend, and the collectors that read the counters kept by
+        its caches and queues when the metrics are scraped
+        """
+        metrics = self.metrics
+        metrics.counter(
+            "webex_websocket_frames_received_total",
+            "Frames received over the websockets",
+        )
+        metrics.counter(
+            "webex_websocket_frames_ignored_total",
+            "Websocket frames that were not passed to the plugins, by reason",
+        )
+        metrics.histogram(
+            "webex_websocket_process_seconds",
+            "Time taken to process a websocket event, by verb",
+        )
+        metrics.histogram(
+            "webex_http_request_seconds",
+            "Latency of calls to the Webex Teams REST API, by endpoint and status",
+        )
+        metrics.counter(
+            "webex_http_rate_limited_total",
+            "Calls to the Webex Teams REST API that were rate limited (HTTP 429)",
+        )
+        metrics.counter("webex_upload_bytes_total", "Bytes of files uploaded")
+        metrics.histogram("webex_upload_seconds", "Time taken to upload a file")
+
+        caches = {
+            "person": self.person_cache,
+            "room": self.room_cache,
+            "markdown": self.renderer.cache,
+            "sent_message": self.sent_messages,
+        }
+        metrics.collector(
+            "webex_cache_hits_total",
+            "counter",
+            "Cache hits, by cache",
+            lambda: [({"cache": name}, cache.hits) for name, cache in caches.items()],
+        )
+        metrics.collector(
+            "webex_cache_misses_total",
+            "counter",
+            "Cache misses, by cache",
+            lambda: [({"cache": name}, cache.misses) for name, cache in caches.items()],
+        )
+        metrics.collector(
+            "webex_cache_entries",
+            "gauge",
+            "Entries held in each cache",
+            lambda: [({"cache": name}, len(cache)) for name, cache in caches.items()],
+        )
+        metrics.collector(
+            "webex_duplicate_activities_total",
+            "counter",
+            "Websocket activities dropped as already received",
+            lambda: [({}, self.seen_activities.dropped)],
+        )
+        metrics.collector(
+            "webex_websocket_dispatch_queue_depth",
+            "gauge",
+            "Websocket events waiting to be processed",
+            lambda: [({}, self.dispatcher.stats()["queue_depth"])],
+        )
+        metrics.collector(
+            "webex_websocket_dispatch_dropped_total",
+            "counter",
+            "Websocket events dropped because the dispatch queue was full",
+            lambda: [({}, self.dispatcher.dropped)],
+        )
+        metrics.collector(
+            "webex_outbound_queue_depth",
+            "gauge",
+            "Outbound messages waiting to be sent, by queue",
+            lambda: [
+                ({"queue": name}, scheduler.queued)
+                for name, scheduler in (
+                    ("outbound", self.outbound),
+                    ("bulk", self.bulk_outbound),
+                )
+                if scheduler is not None
+                and (name == "outbound" or scheduler is not self.outbound)
+            ],
+        )
+        metrics.collector(
+            "webex_websocket_reconnects_total",
+            "counter",
+            "Websocket reconnections, by bot identity",
+            lambda: [
+                ({"identity": identity.email}, identity.reconnects)
+                for identity in self.identities
+            ],
+        )
+
+    def record_response(self, response, *args, **kwargs):
+        """
+        A requests response hook recording the latency and status of each call made through
+        webexpythonsdk
+        """
+        self.metrics.record_request(
+            response.request.method,
+            response.url,
+            response.status_code,
+            response.elapsed.total_seconds(),
+        )
+
+    def websocket_stats(self):
+        """
+        Return the connection state of the websocket of each identity
+        """
+        now = time.monotonic()
+        return {
+            identity.email: {
+                "connected": identity.connected_at is not None,
+                "connection_age": (
+                    now - identity.connected_at if identity.connected_at else 0.0
+                ),
+                "reconnects": identity.reconnects,
+            }
+            for identity in self.identities
+        }
+
     # noinspection PyProtectedMember
-    def _get_device_info(self):
+    def _get_device_info(self, identity):
         """
-        Setup device in Webex Teams to bridge events across websocket
+        Setup device in Webex Teams to bridge events across websocket. The device registered by a
+        previous run is reused if it is still valid, otherwise a new device is registered.
+        :param identity: The CiscoWebexTeamsIdentity to setup the device for
         :return:
         """
-        logging.debug("Getting device list from Webex Teams")
-
-        try:
-            resp = self.webex_teams_api._session.get(DEVICES_URL)
-            for device in resp["devices"]:
-                if device["name"] == DEVICE_DATA["name"]:
-                    self.device_info = device
-                    return device
-        except webexpythonsdk.ApiError:
-            pass
+        devices = self.get(DEVICE_STORAGE_KEY, {}) if self._storage_ready else {}
 
-        logging.info("Device does not exist in Webex Teams, creating")
+        stored = devices.get(identity.token_hash)
+        if stored:
+            try:
+                device = identity.api._session.get(stored["url"])
+                logging.debug(f"Reusing device {stored['url']}")
+                return {**stored, **device}
+            except webexpythonsdk.ApiError:
+                logging.info(f"Stored device {stored['url']} is no longer valid")
+
+        device = self._register_device(identity)
+
+        # Only the devices registered (and recorded) by this bot are ever deleted, as other
+        # processes may be using the same token with their own devices
+        registered = []
+        if stored:
+            registered = stored.get("registered", [stored["url"]])
+            if self.device_cleanup:
+                registered = self._delete_devices(identity, registered)
+
+        if self._storage_ready:
+            devices[identity.token_hash] = {
+                "url": device["url"],
+                "webSocketUrl": device["webSocketUrl"],
+                "registered": registered + [device["url"]],
+            }
+            self[DEVICE_STORAGE_KEY] = devices
+
+        return device
+
+    def _register_device(self, identity):
+        """
+        Register a new device in Webex Teams
+        :param identity: The CiscoWebexTeamsIdentity to register the device for
+        :return: The device
+        """
+        logging.info("Registering a device in Webex Teams")
 
-        resp = self.webex_teams_api._session.post(DEVICES_URL, json=DEVICE_DATA)
+        resp = identity.api._session.post(DEVICES_URL, json=DEVICE_DATA)
         if resp is None:
             raise FailedToCreateWebexDevice(
                 f"Could not create Webex Teams device using {DEVICES_URL}"
             )
 
-        self.device_info = resp
         return resp
 
+    @staticmethod
+    def _delete_devices(identity, urls):
+        """
+        Delete devices previously registered by this bot
+        :param identity: The CiscoWebexTeamsIdentity that registered the devices
+        :param urls: The URLs of the devices
+        :return: The URLs of the devices that could not be deleted, to be retried later
+        """
+        remaining = []
+
+        for url in urls:
+            logging.info(f"Deleting stale device {url}")
+            try:
+                identity.api._session.delete(url)
+            except webexpythonsdk.ApiError as error:
+                if error.response is not None and error.response.status_code == 404:
+                    continue
+
+                logging.warning(f"Could not delete stale device {url}")
+                remaining.append(url)
+
+        return remaining
+
     def change_presence(self, status=OFFLINE, message=""):
         """
         Backend: Change presence yet to be implemented
@@ -999,7 +4799,24 @@ class CiscoWebexTeamsBackend(ErrBot):
             else uuid
         )
 
-    def remember(self, id, key, value):
+    @staticmethod
+    def parse_hydra_id(hydra_id):
+        """
+        Convert a Hydra ID back into the UUID that it encodes
+        :param hydra_id: The Hydra ID to be decoded
+        :return (str): The decoded UUID, or the original ID if it is not a Hydra ID
+        """
+        try:
+            decoded = b64decode(hydra_id + "=" * (-len(hydra_id) % 4)).decode("ascii")
+        except (ValueError, TypeError):
+            return hydra_id
+
+        if not decoded.startswith("ciscospark://"):
+            return hydra_id
+
+        return decoded.rsplit("/", 1)[-1]
+
+    def remember(self, id, key, value, ttl=None):
         """
         Save the value of a key to a dictionary specific to a Webex Teams room or person
         This is available in backend to provide easy access to variables that can be shared between plugins
@@ -1007,10 +4824,53 @@ class CiscoWebexTeamsBackend(ErrBot):
         :param id: Webex Teams ID of room or person
         :param key: The dictionary key
         :param value:  The value to be assigned to the key
+        :param ttl: The number of seconds after which the key is forgotten, or None to keep it
+        """
+        self.keyed_store.set(id, key, value, ttl=ttl)
+
+    def remember_many(self, mapping, ttl=None):
+        """
+        Save the values of keys for many Webex Teams rooms or people at once
+
+        :param mapping: A dictionary of Webex Teams ID to a dictionary of keys and values
+        :param ttl: The number of seconds after which the keys are forgotten, or None to keep them
+        """
+        self.keyed_store.set_many(mapping, ttl=ttl)
+
+    def remember_update(self, id, key, fn, default=None):
+        """
+        Atomically update the value of a key in a dictionary specific to a Webex Teams room or person,
+        for example to increment a counter: remember_update(id, "count", lambda count: count + 1, 0)
+
+        :param id: Webex Teams ID of room or person
+        :param key: The dictionary key
+        :param fn: Called with the current value of the key (or the default) and returns the new value
+        :param default: The value passed to fn if the key is not set
+        :return: The new value
+        """
+        return self.keyed_store.update(id, key, fn, default)
+
+    def recall_many(self, ids, key):
+        """
+        Access the value of a specific key for many Webex Teams rooms or people at once
+
+        :param ids: Webex Teams IDs of rooms or people
+        :param key: The dictionary key
+        :return: A dictionary of ID to the value of the key, or None if the key is not found
+        """
+        return self.keyed_store.get_many(list(ids), key)
+
+    def recall_scan(self, key=None, prefix=None):
+        """
+        Find the Webex Teams rooms or people that have a specific key and/or whose ID (or email
+        address) starts with a prefix, for example every room that has an "on_call" key
+
+        :param key: Only include the IDs that have this key
+        :param prefix: Only include the IDs that start with this prefix
+        :return: A dictionary of ID to the value of the key, or to the dictionary of the ID when
+            no key is given
         """
-        values = self.recall(id)
-        values[key] = value
-        self[id] = values
+        return self.keyed_store.scan(key=key, prefix=prefix)
 
     def forget(self, id, key):
         """
@@ -1020,10 +4880,7 @@ class CiscoWebexTeamsBackend(ErrBot):
         :param key: The dictionary key
         :return: The popped value or None if the key was not found
         """
-        values = self.recall(id)
-        value = values.pop(key, None)
-        self[id] = values
-        return value
+        return self.keyed_store.delete(id, key)
 
     def recall(self, id):
         """
@@ -1032,7 +4889,7 @@ class CiscoWebexTeamsBackend(ErrBot):
         :param id: Webex Teams ID of room or person
         :return: A dictionary. If no dictionary was found an empty dictionary will be returned.
         """
-        return self.get(id, {})
+        return self.keyed_store.get_all(id)
 
     def recall_key(self, id, key):
         """
@@ -1042,21 +4899,59 @@ class CiscoWebexTeamsBackend(ErrBot):
         :param key: The dictionary key
         :return: Either the value of the key or None if the key is not found
         """
-        return self.recall(id).get(key)
+        return self.keyed_store.get(id, key)
 
     @staticmethod
     def _unpickle_identifier(identifier_str):
+        # Identifiers pickled by earlier versions of this backend
         return CiscoWebexTeamsBackend.__build_identifier(identifier_str)
 
+    @staticmethod
+    def _unpickle_compact_identifier(kind, state):
+        backend = CiscoWebexTeamsBackend.__backend
+
+        if kind == "room":
+            room_id, title = state
+            if room_id:
+                return CiscoWebexTeamsRoom(backend=backend, room_id=room_id)
+            return CiscoWebexTeamsRoom(backend=backend, room_title=title)
+
+        person_id, email, display_name = state[:3]
+        person = CiscoWebexTeamsPerson(
+            backend,
+            {
+                "id": person_id,
+                "emails": [email] if email else None,
+                "displayName": display_name,
+            },
+        )
+        if kind == "occupant":
+            return CiscoWebexTeamsRoomOccupant(backend, room=state[3], person=person)
+
+        return person
+
     @staticmethod
     def _pickle_identifier(identifier):
-        return CiscoWebexTeamsBackend._unpickle_identifier, (str(identifier),)
+        # Only the IDs (and the email address and display name of people) are pickled, so that
+        # identifiers are small in storage and can be restored without calling the API
+        if isinstance(identifier, CiscoWebexTeamsRoom):
+            kind = "room"
+            state = (identifier.id, identifier._room_title)
+        else:
+            kind = "person"
+            state = (identifier.id, identifier.email, identifier._display_name)
+            if isinstance(identifier, CiscoWebexTeamsRoomOccupant):
+                kind = "occupant"
+                state += (identifier.room_id,)
+
+        return CiscoWebexTeamsBackend._unpickle_compact_identifier, (kind, state)
 
     def _register_identifiers_pickling(self):
         """
         Register identifiers pickling.
         """
         CiscoWebexTeamsBackend.__build_identifier = self.build_identifier
+        CiscoWebexTeamsBackend.__backend = self
         for cls in (
             CiscoWebexTeamsPerson,
             CiscoWebexTeamsRoomOccupant,